@@ -0,0 +1,216 @@
+"""A local stand-in for the Telegram Bot API, just enough to drive the bot.
+
+It serves getMe, getUpdates (long polling), sendMessage, editMessageText,
+sendChatAction, getChatAdministrators, getChatMember and the few setup calls
+PTB makes at startup. Tests and benchmarks push updates with `push_update` and
+observe what the bot sends through `on_send`. Once the bot calls setWebhook,
+pushed updates are POSTed to its webhook instead, in order, with the secret
+token header, like Telegram does.
+"""
+
+import asyncio
+import itertools
+import json
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set
+from urllib.parse import parse_qsl
+
+import httpx
+
+BOT_USER = {
+    "id": 1000,
+    "is_bot": True,
+    "first_name": "Bench",
+    "username": "bench_bot",
+    "can_join_groups": True,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": False,
+}
+
+
+def user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+
+def chat(chat_id: int) -> dict:
+    if chat_id < 0:
+        return {"id": chat_id, "type": "supergroup", "title": f"chat{chat_id}"}
+    return {"id": chat_id, "type": "private", "first_name": f"user{chat_id}"}
+
+
+class FakeBotAPI:
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        rtt: float = 0.0,
+        admin_ids: Iterable[int] = (),
+    ):
+        self.host = host
+        self.port = port
+        # Users reported as administrators of every chat.
+        self.admin_ids = list(admin_ids)
+        # Artificial latency added to every call, to mimic the real API.
+        self.rtt = rtt
+        self._updates: List[dict] = []
+        self._new_updates = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._server: Optional[asyncio.base_events.Server] = None
+        # Called as on_send(method, params, received_at) for every outgoing call.
+        self.on_send: Optional[Callable[[str, Dict[str, str], float], None]] = None
+        self.calls: Dict[str, int] = {}
+        self._closing = False
+        self._writers: Set[asyncio.StreamWriter] = set()
+        self.webhook_url = ""
+        self.webhook_secret = ""
+        self._webhook_queue: "asyncio.Queue[dict]" = asyncio.Queue()
+        self._webhook_worker: Optional[asyncio.Task] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/bot"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        # Release pending long polls and close keep-alive connections.
+        self._closing = True
+        self._new_updates.set()
+        for writer in list(self._writers):
+            writer.close()
+        if self._webhook_worker is not None:
+            self._webhook_worker.cancel()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def push_update(self, update: dict) -> int:
+        update_id = next(self._update_ids)
+        if self.webhook_url:
+            self._webhook_queue.put_nowait({"update_id": update_id, **update})
+        else:
+            self._updates.append({"update_id": update_id, **update})
+            self._new_updates.set()
+        return update_id
+
+    def push_command(self, chat_id: int, user_id: int, text: str) -> int:
+        command = text.split()[0]
+        return self.push_update(
+            {
+                "message": {
+                    "message_id": next(self._message_ids),
+                    "date": int(time.time()),
+                    "chat": chat(chat_id),
+                    "from": user(user_id),
+                    "text": text,
+                    "entities": [
+                        {"type": "bot_command", "offset": 0, "length": len(command)}
+                    ],
+                }
+            }
+        )
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._writers.add(writer)
+        try:
+            while not self._closing:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode().partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                path = request_line.split()[1].decode()
+                method = path.rsplit("/", 1)[-1]
+                params = dict(parse_qsl(body.decode())) if body else {}
+
+                result = await self._dispatch(method, params)
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\n"
+                    b"Content-Type: application/json\r\n"
+                    + f"Content-Length: {len(payload)}\r\n\r\n".encode()
+                    + payload
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _dispatch(self, method: str, params: Dict[str, str]):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "getUpdates":
+            return await self._get_updates(params)
+
+        received_at = time.perf_counter()
+        if self.rtt:
+            await asyncio.sleep(self.rtt)
+        if self.on_send is not None:
+            self.on_send(method, params, received_at)
+
+        if method == "getMe":
+            return BOT_USER
+        if method == "setWebhook":
+            self.webhook_url = params["url"]
+            self.webhook_secret = params.get("secret_token", "")
+            if self._webhook_worker is None:
+                self._webhook_worker = asyncio.create_task(self._post_updates())
+            return True
+        if method == "deleteWebhook":
+            self.webhook_url = ""
+            return True
+        if method in ("sendMessage", "editMessageText"):
+            return {
+                "message_id": int(params.get("message_id", 0))
+                or next(self._message_ids),
+                "date": int(time.time()),
+                "chat": chat(int(params["chat_id"])),
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        if method == "getChatAdministrators":
+            return [
+                {
+                    "status": "creator",
+                    "user": user(user_id),
+                    "is_anonymous": False,
+                }
+                for user_id in self.admin_ids
+            ]
+        if method == "getChatMember":
+            return {"status": "member", "user": user(int(params["user_id"]))}
+        # setMyCommands, deleteWebhook, sendChatAction, answerCallbackQuery, ...
+        return True
+
+    async def _get_updates(self, params: Dict[str, str]):
+        offset = int(params.get("offset", 0))
+        timeout = float(params.get("timeout", 0))
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates and timeout and not self._closing:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit", 100))
+        return self._updates[:limit]
+
+    async def _post_updates(self):
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.webhook_secret}
+        async with httpx.AsyncClient() as client:
+            while True:
+                update = await self._webhook_queue.get()
+                try:
+                    await client.post(self.webhook_url, json=update, headers=headers)
+                except httpx.HTTPError:
+                    pass
@@ -0,0 +1,292 @@
+"""Load and latency benchmark: the real Application against a fake Bot API.
+
+Run from the repository root, e.g.
+
+    python -m bench.run --rate 50 --duration 30 --chats 200 --out bench_output.txt
+
+A synthetic load generator sends /set, /remind, /all and /cancel at a fixed
+rate (open loop) and the results are printed as JSON: command p50/p99 latency,
+throughput, reminder fire jitter and DB operation timings. Pass a previous
+result with --baseline to get the relative change of every metric, and
+--webhook to have updates POSTed to the bot's webhook instead of polled.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+from collections import defaultdict, deque
+from typing import Deque, Dict, List, Tuple
+
+# The bot reads its configuration at import time, so point it at the fake
+# API and a scratch database before importing anything from it.
+ADMIN_ID = 4242
+GROUP_ID = -4242
+os.environ.update(
+    BOT_TOKEN="1000:bench",
+    GROUP_ID=str(GROUP_ID),
+    PERSONAL_USER_ID=str(ADMIN_ID),
+    LIST_OF_USERS=str(ADMIN_ID),
+    VOLUME_MOUNT_PATH=os.environ.get("BENCH_DB_DIR") or tempfile.mkdtemp(),
+)
+
+import db  # noqa: E402
+from bench.fake_bot_api import FakeBotAPI  # noqa: E402
+
+WEBHOOK_SECRET = "bench-secret"
+COMMAND_MIX = (("set", 0.4), ("all", 0.3), ("cancel", 0.2), ("remind", 0.1))
+REMINDER_TAG = "bench-reminder"
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    """Count and p50/p99/max of samples given in seconds, reported in ms."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pct(p):
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "p50_ms": pct(0.50),
+        "p99_ms": pct(0.99),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+class Recorder:
+    """Matches what the bot sends back to the commands that caused it."""
+
+    def __init__(self):
+        # Commands of a chat are answered in order, so replies match FIFO.
+        self.outstanding: Dict[int, Deque[Tuple[str, float, str, float]]] = defaultdict(
+            deque
+        )
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.expected_fire: Dict[str, float] = {}
+        self.jitter: List[float] = []
+        self.reminders_fired = 0
+
+    def command_sent(self, chat_id: int, command: str, tag: str = "", delay=0.0):
+        self.outstanding[chat_id].append((command, time.perf_counter(), tag, delay))
+
+    def on_send(self, method: str, params: Dict[str, str], received_at: float):
+        if method != "sendMessage":
+            return
+        text = params.get("text", "")
+        if text.startswith(REMINDER_TAG):
+            self.reminders_fired += 1
+            expected = self.expected_fire.pop(text, None)
+            if expected is not None:
+                self.jitter.append(received_at - expected)
+            return
+        queue = self.outstanding.get(int(params["chat_id"]))
+        if not queue:
+            return
+        command, sent_at, tag, delay = queue.popleft()
+        self.latencies[command].append(received_at - sent_at)
+        if command == "set":
+            self.expected_fire[tag] = received_at + delay
+
+    @property
+    def unanswered(self) -> int:
+        return sum(len(queue) for queue in self.outstanding.values())
+
+
+def time_db_calls() -> Dict[str, List[float]]:
+    """Wrap db._run so every storage call is timed, labelled by its statement."""
+    names = {
+        value: name
+        for name, value in vars(db).items()
+        if name.startswith("_") and isinstance(value, str)
+    }
+    timings: Dict[str, List[float]] = defaultdict(list)
+    run = db._run
+
+    async def timed_run(func, *args, **kwargs):
+        label = func.__name__
+        if args and isinstance(args[0], str):
+            label = names.get(args[0], label)
+        start = time.perf_counter()
+        try:
+            return await run(func, *args, **kwargs)
+        finally:
+            timings[label].append(time.perf_counter() - start)
+
+    db._run = timed_run
+    return timings
+
+
+async def generate_load(api: FakeBotAPI, recorder: Recorder, args):
+    chats = [GROUP_ID] + [-(10_000 + i) for i in range(args.chats - 1)]
+    commands, weights = zip(*COMMAND_MIX)
+    uids = itertools.count()
+    # Updates are handled one at a time, so the n-th /set or /remind creates
+    # the reminder with seq n in the fresh DB; /cancel picks one of those.
+    rowids = itertools.count(1)
+    chat_rowids: Dict[int, List[int]] = defaultdict(list)
+    rng = random.Random(args.seed)
+    interval = 1 / args.rate
+    start = time.perf_counter()
+    for n in range(int(args.rate * args.duration)):
+        # Open loop: keep the schedule regardless of how fast the bot answers.
+        await asyncio.sleep(max(0.0, start + n * interval - time.perf_counter()))
+        chat_id = rng.choice(chats)
+        command = rng.choices(commands, weights)[0]
+        if command == "set":
+            delay = rng.uniform(args.min_delay, args.max_delay)
+            tag = f"{REMINDER_TAG} {next(uids)}"
+            recorder.command_sent(chat_id, command, tag, delay)
+            api.push_command(chat_id, ADMIN_ID, f"/set {tag} {delay:.3f}s")
+            chat_rowids[chat_id].append(next(rowids))
+        elif command == "remind":
+            recorder.command_sent(chat_id, command)
+            api.push_command(chat_id, ADMIN_ID, f"/remind {REMINDER_TAG} hourly")
+            chat_rowids[chat_id].append(next(rowids))
+        elif command == "cancel":
+            own = chat_rowids[chat_id]
+            rowid = own.pop(rng.randrange(len(own))) if own else 0
+            recorder.command_sent(chat_id, command)
+            api.push_command(chat_id, ADMIN_ID, f"/cancel {rowid}")
+        else:
+            recorder.command_sent(chat_id, command)
+            api.push_command(chat_id, ADMIN_ID, "/all")
+    return time.perf_counter() - start
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def run(args) -> dict:
+    from main import ALLOWED_UPDATES, build_application
+
+    recorder = Recorder()
+    api = FakeBotAPI(rtt=args.rtt, admin_ids=[ADMIN_ID])
+    api.on_send = recorder.on_send
+    await api.start()
+    db_timings = time_db_calls()
+
+    application = build_application(base_url=api.base_url)
+    # The same lifecycle as Application.run_polling, inside our own loop.
+    await application.initialize()
+    await application.post_init(application)
+    if args.webhook:
+        port = free_port()
+        await application.updater.start_webhook(
+            listen="127.0.0.1",
+            port=port,
+            url_path="webhook",
+            webhook_url=f"http://127.0.0.1:{port}/webhook",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+    else:
+        await application.updater.start_polling(
+            poll_interval=0, timeout=10, allowed_updates=ALLOWED_UPDATES
+        )
+    await application.start()
+
+    elapsed = await generate_load(api, recorder, args)
+    # Give the bot time to answer everything and fire the pending reminders.
+    deadline = time.perf_counter() + args.max_delay + args.drain
+    while time.perf_counter() < deadline and (
+        recorder.unanswered or recorder.expected_fire
+    ):
+        await asyncio.sleep(0.1)
+
+    await application.updater.stop()
+    await application.stop()
+    await application.post_stop(application)
+    await application.shutdown()
+    await application.post_shutdown(application)
+    await api.stop()
+
+    answered = sum(len(samples) for samples in recorder.latencies.values())
+    return {
+        "config": vars(args),
+        "load_seconds": round(elapsed, 3),
+        "throughput_per_s": round(answered / elapsed, 3),
+        "commands": {
+            command: summarize(samples)
+            for command, samples in sorted(recorder.latencies.items())
+        },
+        "all_commands": summarize(
+            [sample for samples in recorder.latencies.values() for sample in samples]
+        ),
+        "unanswered": recorder.unanswered,
+        "reminders": {
+            "fired": recorder.reminders_fired,
+            "not_fired": len(recorder.expected_fire),
+            "jitter": summarize(recorder.jitter),
+        },
+        "db": {
+            label: summarize(samples) for label, samples in sorted(db_timings.items())
+        },
+        "api_calls": dict(sorted(api.calls.items())),
+    }
+
+
+def compare(baseline: dict, result: dict, path: str = "") -> dict:
+    """Relative change (new / old - 1) of every numeric metric in both results."""
+    changes = {}
+    for key, new in result.items():
+        old = baseline.get(key)
+        name = f"{path}.{key}" if path else key
+        if key == "config":
+            continue
+        if isinstance(new, dict) and isinstance(old, dict):
+            changes.update(compare(old, new, name))
+        elif isinstance(new, (int, float)) and isinstance(old, (int, float)) and old:
+            changes[name] = round(new / old - 1, 4)
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate", type=float, default=20, help="commands per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load")
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--min-delay", type=float, default=1, help="/set delay, s")
+    parser.add_argument("--max-delay", type=float, default=5, help="/set delay, s")
+    parser.add_argument("--rtt", type=float, default=0.0, help="fake API latency, s")
+    parser.add_argument("--drain", type=float, default=30, help="max wait after load")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--webhook", action="store_true", help="receive updates through a webhook"
+    )
+    parser.add_argument("--out", help="also append the JSON result to this file")
+    parser.add_argument("--baseline", help="JSON result of an earlier run")
+    args = parser.parse_args()
+
+    # Log the way main.py does, so logging costs the same as in production.
+    from utils.logs import setup_logging, stop_logging
+
+    setup_logging()
+    try:
+        result = asyncio.run(run(args))
+    finally:
+        stop_logging()
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.loads(f.read().splitlines()[-1])
+        result["change_vs_baseline"] = compare(baseline, result)
+    output = json.dumps(result)
+    print(output)
+    if args.out:
+        with open(args.out, "a") as f:
+            f.write(output + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
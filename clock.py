@@ -0,0 +1,28 @@
+"""The current time, as scheduling and bookkeeping code sees it.
+
+That code calls clock.now() and clock.time() rather than datetime.now() and
+time.time(), so simulate.py can run it on virtual time with set_clock().
+Rate limiting and timeouts keep using the real monotonic clock.
+"""
+
+import time as _time
+from datetime import datetime, timezone
+from typing import Callable
+
+_time_func: Callable[[], float] = _time.time
+
+
+def set_clock(time_func: Callable[[], float]):
+    """Make `time_func` (epoch seconds) the source of the current time."""
+    global _time_func
+    _time_func = time_func
+
+
+def time() -> float:
+    """Seconds since the epoch."""
+    return _time_func()
+
+
+def now() -> datetime:
+    """The current time in UTC."""
+    return datetime.fromtimestamp(_time_func(), timezone.utc)
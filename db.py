@@ -1,19 +1,114 @@
+import asyncio
+import json
+import logging
 import os
 import sqlite3
-from datetime import datetime, timedelta, timezone
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from glob import glob
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set
 
 from telegram.ext import (
     Application,
 )
 from telegram.ext._utils.types import JobCallback
 
+import clock
+from metrics import db_query_latency
+from recurrence import compile_rule
+from scheduling import schedule_reminder
+from settings import (
+    DB_SHARDS,
+    DELIVERY_LOG_DAYS,
+    FIRE_BATCH_WINDOW,
+    LATE_DELIVERY_RATE,
+    LEASE_DURATION,
+    LOAD_HORIZON,
+    MISSED_ONESHOT_POLICY,
+    WORKER_ID,
+)
+from utils.helpers import from_epoch_ms, to_epoch_ms
+
+logger = logging.getLogger(__name__)
+
 DB_PATH = os.path.join(os.getenv("VOLUME_MOUNT_PATH", "."), "jobs.db")
 
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
+def shard_path(index: int, shards: int = DB_SHARDS) -> str:
+    """The file of shard `index` out of `shards`; a single shard is DB_PATH."""
+    if shards == 1:
+        return DB_PATH
+    root, ext = os.path.splitext(DB_PATH)
+    return f"{root}-{index}-of-{shards}{ext}"
+
+
+def shard_for(chat_id: int, shards: int = DB_SHARDS) -> int:
+    """The shard holding a chat's jobs, settings and delivery history."""
+    return zlib.crc32(chat_id.to_bytes(8, "little", signed=True)) % shards
+
+
+# Every statement runs on the thread of its shard, which owns one long-lived
+# connection to the shard's file. Handlers await the result instead of
+# blocking the event loop on file I/O and fsync, and each file only ever has
+# one writer in this process. Statements about one chat go to its shard; the
+# others run on all shards at once.
+_local = threading.local()
+
+
+def _bind_shard(index: int):
+    _local.shard = index
+    _local.conn = None
+    # Day tables this connection has created (or seen), to skip the DDL.
+    _local.delivery_tables = set()
+
+
+_executors = [
+    ThreadPoolExecutor(
+        max_workers=1,
+        thread_name_prefix=f"jobs-db-{index}",
+        initializer=_bind_shard,
+        initargs=(index,),
+    )
+    for index in range(DB_SHARDS)
+]
+
+# Write-behind buffer for the bookkeeping done after every reminder fire.
+# reminder_callback queues next-run updates and removals here and
+# flush_pending_writes() applies them in one transaction per tick. Losing an
+# unflushed batch in a crash is safe: on restart recover_missed_jobs moves
+# overdue repeating jobs to their next slot and drops one-shot jobs that are
+# already past due, which is what the lost writes would have done (with
+# MISSED_ONESHOT_POLICY=late those one-shot reminders are sent a second time).
+# With SCHEDULER_MODE=leased the leases of a lost batch lapse instead, and the
+# jobs fire once more on whichever worker claims them next.
+_pending_next_run: Dict[str, int] = {}
+_pending_removals: Set[str] = set()
+# The chat of each pending job, which picks the shard it is written to.
+_pending_chats: Dict[str, int] = {}
+
+# Delivery log, appended to by the delivery queue and written with the next
+# flush. Deliveries go in one table per UTC day, deliveries_YYYYMMDD, so
+# pruning drops whole tables instead of deleting rows and the jobs table never
+# grows with history. auto_vacuum=INCREMENTAL hands the freed pages back.
+_pending_deliveries: List[tuple] = []
+
+# Reminders that fire together are read with one query: get_due_job() calls
+# made within FIRE_BATCH_WINDOW of the first share a single SELECT.
+_due_batch: Dict[str, asyncio.Future] = {}
+_due_fetches: Set[asyncio.Task] = set()
+
+# Jobs are registered with the job queue lazily, one LOAD_HORIZON at a time.
+_loaded_until = 0
+
+# Schema migrations, applied in order by init_db. PRAGMA user_version records
+# how many have run, so existing jobs.db files are upgraded in place at
+# startup. Append new steps; never edit one that has shipped.
+_MIGRATIONS = (
+    # 1: the original schema.
+    (
         """
         CREATE TABLE IF NOT EXISTS jobs (
             id TEXT PRIMARY KEY,
@@ -23,133 +118,970 @@ def init_db():
             interval TEXT,
             next_run_time TEXT NOT NULL
         )
-    """
+        """,
+    ),
+    # 2: next_run_time as integer epoch milliseconds instead of ISO strings.
+    # The table is rebuilt with the same rowids, which /all uses as cursors.
+    (
+        """
+        CREATE TABLE jobs_new (
+            id TEXT PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            interval TEXT,
+            next_run_time INTEGER NOT NULL
+        )
+        """,
+        """
+        INSERT INTO jobs_new (rowid, id, chat_id, user_id, message, interval, next_run_time)
+        SELECT rowid, id, chat_id, user_id, message, interval, iso_to_epoch_ms(next_run_time)
+        FROM jobs
+        """,
+        "DROP TABLE jobs",
+        "ALTER TABLE jobs_new RENAME TO jobs",
+    ),
+    # 3: per-chat listing walks (chat_id, rowid); due-time scans are covered
+    # by the second index without touching the table.
+    (
+        "CREATE INDEX idx_jobs_chat ON jobs (chat_id)",
+        """
+        CREATE INDEX idx_jobs_due
+        ON jobs (next_run_time, id, chat_id, user_id, interval)
+        """,
+    ),
+    # 4: per-chat settings; coalesce_window is NULL unless the chat opted in.
+    (
+        """
+        CREATE TABLE chat_settings (
+            chat_id INTEGER PRIMARY KEY,
+            coalesce_window REAL
+        )
+        """,
+    ),
+    # 5: leases for SCHEDULER_MODE=leased. lease_owner is the WORKER_ID that
+    # claimed the job and lease_expires the epoch ms until which it holds it.
+    (
+        "ALTER TABLE jobs ADD COLUMN lease_owner TEXT",
+        "ALTER TABLE jobs ADD COLUMN lease_expires INTEGER",
+    ),
+    # 6: the IANA time zone cron rules of a chat use, NULL for UTC.
+    ("ALTER TABLE chat_settings ADD COLUMN timezone TEXT",),
+    # 7: seq, the number /all shows and /cancel takes. AUTOINCREMENT keeps
+    # SQLite from handing the number of the newest job to the next one once
+    # it is deleted; existing jobs keep their rowid as their number.
+    (
+        """
+        CREATE TABLE jobs_new (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id TEXT NOT NULL UNIQUE,
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            interval TEXT,
+            next_run_time INTEGER NOT NULL,
+            lease_owner TEXT,
+            lease_expires INTEGER
+        )
+        """,
+        """
+        INSERT INTO jobs_new (seq, id, chat_id, user_id, message, interval,
+            next_run_time, lease_owner, lease_expires)
+        SELECT rowid, id, chat_id, user_id, message, interval, next_run_time,
+            lease_owner, lease_expires
+        FROM jobs
+        """,
+        "DROP TABLE jobs",
+        "ALTER TABLE jobs_new RENAME TO jobs",
+        "CREATE INDEX idx_jobs_chat ON jobs (chat_id)",
+        """
+        CREATE INDEX idx_jobs_due
+        ON jobs (next_run_time, id, chat_id, user_id, interval)
+        """,
+    ),
+)
+
+# Statements are kept as constants so sqlite3's statement cache reuses the
+# prepared statement for every call.
+_INSERT_JOB = """
+    INSERT INTO jobs (id, chat_id, user_id, message, interval, next_run_time)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+_IMPORT_JOB = """
+    INSERT INTO jobs (id, chat_id, user_id, message, interval, next_run_time)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (id) DO NOTHING
+"""
+_DELETE_JOB = "DELETE FROM jobs WHERE id = ?"
+# /cancel addresses jobs by seq, the stable number /all shows, within a chat.
+_DELETE_CHAT_JOB = "DELETE FROM jobs WHERE chat_id = ? AND seq = ? RETURNING seq, id"
+_DELETE_CHAT_JOBS = "DELETE FROM jobs WHERE chat_id = ? RETURNING seq, id"
+# Moving a job on also releases any lease on it.
+_UPDATE_NEXT_RUN_TIME = """
+    UPDATE jobs SET next_run_time = ?, lease_owner = NULL, lease_expires = NULL
+    WHERE id = ?
+"""
+_SELECT_CHAT_JOBS = (
+    "SELECT id, chat_id, user_id, message, interval, next_run_time"
+    " FROM jobs WHERE chat_id = ?"
+)
+_SELECT_ALL_JOBS = (
+    "SELECT id, chat_id, user_id, message, interval, next_run_time"
+    " FROM jobs ORDER BY rowid"
+)
+_SELECT_CHAT_JOBS_ORDERED = _SELECT_CHAT_JOBS + " ORDER BY rowid"
+# The ids are passed as one JSON array, so the statement text (and its cached
+# prepared statement) is the same however many jobs fire together.
+_SELECT_JOBS_BY_IDS = (
+    "SELECT id, chat_id, user_id, message, interval, next_run_time,"
+    " lease_owner, lease_expires FROM jobs"
+    " WHERE id IN (SELECT value FROM json_each(?))"
+)
+_SELECT_CHAT_PAGE_AFTER = (
+    "SELECT seq, id, chat_id, user_id, message, interval, next_run_time"
+    " FROM jobs WHERE chat_id = ? AND seq > ? ORDER BY seq LIMIT ?"
+)
+_SELECT_CHAT_PAGE_BEFORE = (
+    "SELECT seq, id, chat_id, user_id, message, interval, next_run_time"
+    " FROM jobs WHERE chat_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?"
+)
+_SELECT_JOBS_WINDOW = (
+    "SELECT id, chat_id, user_id, interval, next_run_time FROM jobs"
+    " WHERE (next_run_time, id) > (?, ?) AND next_run_time < ?"
+    " ORDER BY next_run_time, id LIMIT ?"
+)
+# Pages of every job for exports across shards; rowid comes last, so it is
+# left out of the exported fields.
+_SELECT_JOBS_AFTER_ROWID = (
+    "SELECT id, chat_id, user_id, message, interval, next_run_time, rowid"
+    " FROM jobs WHERE rowid > ? ORDER BY rowid LIMIT ?"
+)
+_LOAD_BATCH = 500
+# Startup recovery, set-based so a long outage costs a handful of statements.
+# Repeating jobs skip the runs they missed, landing on their next slot after
+# now: rules with a fixed interval in one UPDATE, passed a JSON object of rule
+# to milliseconds, and cron rules row by row. One-shot jobs are dropped or,
+# with MISSED_ONESHOT_POLICY=late, moved to :start in order of their original
+# time, spaced by the given milliseconds.
+_SELECT_OVERDUE_RULES = (
+    "SELECT DISTINCT interval FROM jobs"
+    " WHERE interval IS NOT NULL AND next_run_time < ?"
+)
+_UPDATE_CATCH_UP = """
+    UPDATE jobs
+    SET next_run_time = next_run_time + ((:now - next_run_time) / steps.value + 1) * steps.value
+    FROM json_each(:steps) AS steps
+    WHERE jobs.interval = steps.key AND jobs.next_run_time < :now
+"""
+_SELECT_OVERDUE_CRON = (
+    "SELECT id, interval, next_run_time FROM jobs"
+    " WHERE interval IN (SELECT value FROM json_each(?)) AND next_run_time < ?"
+)
+_DELETE_MISSED = "DELETE FROM jobs WHERE interval IS NULL AND next_run_time < ?"
+_UPDATE_RESCHEDULE_MISSED = """
+    UPDATE jobs SET next_run_time = :start + missed.n * :spacing
+    FROM (
+        SELECT id, row_number() OVER (ORDER BY next_run_time, id) AS n FROM jobs
+        WHERE interval IS NULL AND next_run_time < :now
+    ) AS missed
+    WHERE jobs.id = missed.id
+"""
+# The UPDATE takes SQLite's write lock, so concurrent claims from several
+# processes never return the same row. Due jobs come first along idx_jobs_due.
+_CLAIM_JOBS = """
+    UPDATE jobs SET lease_owner = ?, lease_expires = max(next_run_time, ?) + ?
+    WHERE id IN (
+        SELECT id FROM jobs
+        WHERE next_run_time < ? AND (lease_expires IS NULL OR lease_expires < ?)
+        ORDER BY next_run_time
+        LIMIT ?
+    )
+    RETURNING id, chat_id, user_id, interval, next_run_time
+"""
+_UPDATE_RELEASE_LEASES = (
+    "UPDATE jobs SET lease_owner = NULL, lease_expires = NULL WHERE lease_owner = ?"
+)
+_UPSERT_COALESCE_WINDOW = """
+    INSERT INTO chat_settings (chat_id, coalesce_window) VALUES (?, ?)
+    ON CONFLICT (chat_id) DO UPDATE SET coalesce_window = excluded.coalesce_window
+"""
+_SELECT_COALESCE_WINDOWS = (
+    "SELECT chat_id, coalesce_window FROM chat_settings"
+    " WHERE coalesce_window IS NOT NULL"
+)
+_UPSERT_TIMEZONE = """
+    INSERT INTO chat_settings (chat_id, timezone) VALUES (?, ?)
+    ON CONFLICT (chat_id) DO UPDATE SET timezone = excluded.timezone
+"""
+_SELECT_TIMEZONE = "SELECT timezone FROM chat_settings WHERE chat_id = ?"
+# Templates for the per-day delivery tables; {table} is deliveries_YYYYMMDD.
+_CREATE_DELIVERIES = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        job_id TEXT NOT NULL,
+        chat_id INTEGER NOT NULL,
+        scheduled INTEGER NOT NULL,
+        sent INTEGER NOT NULL,
+        outcome TEXT NOT NULL
+    )
+"""
+_CREATE_DELIVERIES_INDEX = (
+    "CREATE INDEX IF NOT EXISTS {table}_chat ON {table} (chat_id, sent)"
+)
+_INSERT_DELIVERY = "INSERT INTO {table} VALUES (?, ?, ?, ?, ?)"
+_SELECT_DELIVERY_TABLES = (
+    "SELECT name FROM sqlite_master"
+    " WHERE type = 'table' AND name GLOB 'deliveries_[0-9]*' ORDER BY name DESC"
+)
+# Rows are appended in the order they were sent, so rowid order is send order.
+_SELECT_DELIVERIES = (
+    "SELECT job_id, chat_id, scheduled, sent, outcome FROM {table}"
+    " ORDER BY rowid DESC LIMIT ?"
+)
+_SELECT_CHAT_DELIVERIES = (
+    "SELECT job_id, chat_id, scheduled, sent, outcome FROM {table}"
+    " WHERE chat_id = ? ORDER BY sent DESC LIMIT ?"
+)
+
+# Metric labels for the statements above, e.g. "select_chat_jobs".
+_QUERY_NAMES = {
+    sql: name.strip("_").lower()
+    for name, sql in list(globals().items())
+    if name.startswith(
+        ("_SELECT_", "_INSERT_", "_UPDATE_", "_DELETE_", "_UPSERT_", "_CLAIM_")
+    )
+}
+
+
+def _open(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, cached_statements=64)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    # WAL keeps the DB consistent with NORMAL; only the last commits can be
+    # lost on power failure, and load_jobs_from_db catches those up.
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def _connection() -> sqlite3.Connection:
+    """Return this shard thread's connection, opening it on first use."""
+    if _local.conn is None:
+        _local.conn = _open(shard_path(_local.shard))
+    return _local.conn
+
+
+async def _run(func, *args, shard: int = 0):
+    # Calls taking a statement are labelled with its name, others with func's.
+    query = func.__name__
+    if args and isinstance(args[0], str):
+        query = _QUERY_NAMES.get(args[0], query)
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        return await loop.run_in_executor(_executors[shard], func, *args)
+    finally:
+        db_query_latency.observe(time.perf_counter() - start, query)
+
+
+async def _run_all(func, *args) -> list:
+    """_run on every shard concurrently; returns the results in shard order."""
+    return await asyncio.gather(
+        *(_run(func, *args, shard=shard) for shard in range(DB_SHARDS))
     )
-    conn.commit()
-    conn.close()
 
 
-def save_job_to_db(
+def _iso_to_epoch_ms(value: str) -> int:
+    return to_epoch_ms(datetime.fromisoformat(value))
+
+
+def _migrate(conn: sqlite3.Connection):
+    conn.create_function("iso_to_epoch_ms", 1, _iso_to_epoch_ms, deterministic=True)
+    while True:
+        with conn:
+            # Take the write lock before reading the version, so processes
+            # starting together on one DB apply each step exactly once.
+            conn.execute("BEGIN IMMEDIATE")
+            current = conn.execute("PRAGMA user_version").fetchone()[0]
+            if current >= len(_MIGRATIONS):
+                return
+            for statement in _MIGRATIONS[current]:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {current + 1}")
+
+
+def _check_layout():
+    """Refuse to start on files written with another DB_SHARDS."""
+    root, ext = os.path.splitext(DB_PATH)
+    current = {shard_path(index) for index in range(DB_SHARDS)}
+    others = [
+        path
+        for path in [DB_PATH, *sorted(glob(f"{root}-*-of-*{ext}"))]
+        if os.path.exists(path) and path not in current
+    ]
+    if others:
+        raise RuntimeError(
+            f"{', '.join(others)} hold jobs for another DB_SHARDS than"
+            f" {DB_SHARDS}; move them over with reshard.py"
+        )
+
+
+def _prepare(conn: sqlite3.Connection):
+    _migrate(conn)
+    # Files created before the delivery log have auto_vacuum off; switching it
+    # on needs a one-off VACUUM.
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+
+
+def _init_db():
+    _prepare(_connection())
+
+
+def _close_db():
+    if _local.conn is not None:
+        _local.conn.close()
+        _local.conn = None
+        _local.delivery_tables.clear()
+
+
+def _save_job(job_id, chat_id, user_id, message, interval, next_run_time):
+    conn = _connection()
+    with conn:
+        cursor = conn.execute(
+            _INSERT_JOB, (job_id, chat_id, user_id, message, interval, next_run_time)
+        )
+    return cursor.lastrowid
+
+
+def _delete_chat_jobs(chat_id: int, seqs: Optional[List[int]]) -> Dict[int, str]:
+    conn = _connection()
+    with conn:
+        if seqs is None:
+            rows = conn.execute(_DELETE_CHAT_JOBS, (chat_id,)).fetchall()
+        else:
+            rows = [
+                row
+                for seq in seqs
+                for row in conn.execute(_DELETE_CHAT_JOB, (chat_id, seq)).fetchall()
+            ]
+    return {row["seq"]: row["id"] for row in rows}
+
+
+def _import(rows: Iterable[tuple], register_until: int):
+    conn = _connection()
+    due = []
+
+    def collect():
+        for row in rows:
+            if row[5] < register_until:
+                due.append(row)
+            yield row
+
+    before = conn.total_changes
+    with conn:
+        conn.executemany(_IMPORT_JOB, collect())
+    return conn.total_changes - before, due
+
+
+def _export(write: Callable[[Iterable], int], chat_id: Optional[int]) -> int:
+    conn = _connection()
+    if chat_id is None:
+        return write(conn.execute(_SELECT_ALL_JOBS))
+    return write(conn.execute(_SELECT_CHAT_JOBS_ORDERED, (chat_id,)))
+
+
+def _execute_write(sql: str, params: tuple):
+    conn = _connection()
+    with conn:
+        conn.execute(sql, params)
+
+
+def _delivery_table(sent: int) -> str:
+    return "deliveries_" + time.strftime("%Y%m%d", time.gmtime(sent / 1000))
+
+
+def _apply_pending(updates, removals, deliveries):
+    conn = _connection()
+    with conn:
+        conn.executemany(
+            _UPDATE_NEXT_RUN_TIME,
+            ((next_run_time, job_id) for job_id, next_run_time in updates.items()),
+        )
+        conn.executemany(_DELETE_JOB, ((job_id,) for job_id in removals))
+        tables: Dict[str, List[tuple]] = {}
+        for delivery in deliveries:
+            tables.setdefault(_delivery_table(delivery[3]), []).append(delivery)
+        for table, rows in tables.items():
+            if table not in _local.delivery_tables:
+                conn.execute(_CREATE_DELIVERIES.format(table=table))
+                conn.execute(_CREATE_DELIVERIES_INDEX.format(table=table))
+                _local.delivery_tables.add(table)
+            conn.executemany(_INSERT_DELIVERY.format(table=table), rows)
+
+
+def _prune_deliveries(oldest: str) -> int:
+    conn = _connection()
+    tables = [
+        name
+        for (name,) in conn.execute(_SELECT_DELIVERY_TABLES).fetchall()
+        if name < oldest
+    ]
+    with conn:
+        for table in tables:
+            conn.execute(f"DROP TABLE IF EXISTS {table}")
+            _local.delivery_tables.discard(table)
+    # Give the freed pages back to the file system without rewriting the whole
+    # file like VACUUM would. The pragma frees one page per step and sqlite3's
+    # cursor stops after one step; executescript runs it to completion.
+    conn.executescript("PRAGMA incremental_vacuum")
+    return len(tables)
+
+
+def _recent_deliveries(chat_id: Optional[int], limit: int) -> List[sqlite3.Row]:
+    conn = _connection()
+    rows: List[sqlite3.Row] = []
+    for (table,) in conn.execute(_SELECT_DELIVERY_TABLES).fetchall():
+        if chat_id is None:
+            rows += conn.execute(
+                _SELECT_DELIVERIES.format(table=table), (limit - len(rows),)
+            ).fetchall()
+        else:
+            rows += conn.execute(
+                _SELECT_CHAT_DELIVERIES.format(table=table),
+                (chat_id, limit - len(rows)),
+            ).fetchall()
+        if len(rows) >= limit:
+            break
+    return rows
+
+
+def _recover(now: int, start: int, spacing: Optional[int]):
+    conn = _connection()
+    steps, crons = {}, []
+    for (text,) in conn.execute(_SELECT_OVERDUE_RULES, (now,)).fetchall():
+        try:
+            rule = compile_rule(text)
+        except ValueError as e:
+            logger.warning("Not catching up jobs with interval %r: %s", text, e)
+            continue
+        if rule.period_ms:
+            steps[text] = rule.period_ms
+        else:
+            crons.append(text)
+    with conn:
+        caught_up = conn.execute(
+            _UPDATE_CATCH_UP, {"now": now, "steps": json.dumps(steps)}
+        ).rowcount
+        if crons:
+            rows = conn.execute(_SELECT_OVERDUE_CRON, (json.dumps(crons), now))
+            moved = [
+                (compile_rule(text).next_after(next_run_time, now), job_id)
+                for job_id, text, next_run_time in rows.fetchall()
+            ]
+            conn.executemany(_UPDATE_NEXT_RUN_TIME, moved)
+            caught_up += len(moved)
+        if spacing is None:
+            missed = conn.execute(_DELETE_MISSED, (now,)).rowcount
+        else:
+            params = {"now": now, "start": start, "spacing": spacing}
+            missed = conn.execute(_UPDATE_RESCHEDULE_MISSED, params).rowcount
+    return caught_up, missed
+
+
+def _claim(sql: str, params: tuple):
+    conn = _connection()
+    with conn:
+        return conn.execute(sql, params).fetchall()
+
+
+def _fetchall(sql: str, params: tuple = ()):
+    return _connection().execute(sql, params).fetchall()
+
+
+def _fetchone(sql: str, params: tuple = ()):
+    return _connection().execute(sql, params).fetchone()
+
+
+def _split_by_chat(rows: Iterable[tuple]) -> Dict[int, List[tuple]]:
+    shards: Dict[int, List[tuple]] = {}
+    for row in rows:
+        shards.setdefault(shard_for(row[1]), []).append(row)
+    return shards
+
+
+def _all_jobs() -> Iterator[sqlite3.Row]:
+    """Every jobs row, shard after shard, read a page at a time on its thread."""
+    for executor in _executors:
+        cursor = 0
+        while True:
+            rows = executor.submit(
+                _fetchall, _SELECT_JOBS_AFTER_ROWID, (cursor, _LOAD_BATCH)
+            ).result()
+            yield from rows
+            if len(rows) < _LOAD_BATCH:
+                break
+            cursor = rows[-1]["rowid"]
+
+
+async def init_db():
+    _check_layout()
+    await _run_all(_init_db)
+
+
+async def close_db():
+    await _run_all(_close_db)
+
+
+async def save_job_to_db(
     job_id: str,
     chat_id: int,
     user_id: int,
     message: str,
     interval: str,
-    next_run_time: str,
+    next_run_time: int,
 ):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        INSERT INTO jobs (id,chat_id, user_id, message, interval, next_run_time)
-        VALUES (?,?, ?, ?, ?, ?)
-    """,
-        (job_id, chat_id, user_id, message, interval, next_run_time),
+    return await _run(
+        _save_job,
+        job_id,
+        chat_id,
+        user_id,
+        message,
+        interval,
+        next_run_time,
+        shard=shard_for(chat_id),
     )
-    job_id = cursor.lastrowid
 
-    conn.commit()
-    conn.close()
-    return job_id
+
+async def remove_chat_jobs_from_db(
+    chat_id: int, seqs: Optional[List[int]] = None
+) -> Dict[int, str]:
+    """Delete a chat's jobs by seq, or all of them, in one transaction.
+
+    Seqs of other chats are ignored. Returns the ids of the deleted jobs by
+    seq, so the caller can drop them from the job queue and tell which seqs
+    matched nothing.
+    """
+    deleted = await _run(_delete_chat_jobs, chat_id, seqs, shard=shard_for(chat_id))
+    for job_id in deleted.values():
+        _pending_next_run.pop(job_id, None)
+        _pending_removals.discard(job_id)
+    return deleted
 
 
-def remove_job_from_db(job_id: int):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
-    conn.commit()
-    conn.close()
+async def import_jobs(rows: Iterable[tuple], register_until: int = 0):
+    """Insert jobs rows with one executemany in a single transaction.
 
+    `rows` is consumed lazily on the DB thread; if it raises, nothing is
+    written. Rows whose id already exists are skipped. Returns the number
+    inserted and the rows due before `register_until`, which the caller has to
+    register with the job queue (see schedule_jobs).
 
-def update_job_next_run_time(job_id: str, next_run_time: str):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE jobs SET next_run_time = ? WHERE id = ?",
-        (next_run_time, job_id),
+    With DB_SHARDS > 1 the rows can only be split by chat once read, so all of
+    them are read first and then each shard inserts its part in a transaction
+    of its own.
+    """
+    if DB_SHARDS == 1:
+        return await _run(_import, rows, register_until)
+    loop = asyncio.get_running_loop()
+    parts = await loop.run_in_executor(None, _split_by_chat, rows)
+    results = await asyncio.gather(
+        *(
+            _run(_import, part, register_until, shard=shard)
+            for shard, part in parts.items()
+        )
     )
-    conn.commit()
-    cursor.close()
-    conn.close()
+    return sum(inserted for inserted, _ in results), [
+        row for _, due in results for row in due
+    ]
 
 
-def get_jobs_from_db(chat_id: int):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT id, chat_id, user_id, message, interval, next_run_time FROM jobs WHERE chat_id = ?",
-        (chat_id,),
+async def export_jobs(
+    write: Callable[[Iterable], int], chat_id: Optional[int] = None
+) -> int:
+    """Call write(cursor) on the DB thread with a cursor over the jobs rows.
+
+    Rows are id, chat_id, user_id, message, interval, next_run_time in
+    creation order, of one chat or of all (shard after shard, with
+    DB_SHARDS > 1, from another thread). `write` must not touch the event
+    loop; its return value is passed through.
+    """
+    if chat_id is not None:
+        return await _run(_export, write, chat_id, shard=shard_for(chat_id))
+    if DB_SHARDS == 1:
+        return await _run(_export, write, None)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, write, _all_jobs())
+
+
+def queue_next_run_update(job_id: str, chat_id: int, next_run_time: int) -> int:
+    """Buffer a next-run update for the next flush. Returns the pending count."""
+    _pending_removals.discard(job_id)
+    _pending_next_run[job_id] = next_run_time
+    _pending_chats[job_id] = chat_id
+    return pending_write_count()
+
+
+def queue_job_removal(job_id: str, chat_id: int) -> int:
+    """Buffer a removal for the next flush. Returns the pending count."""
+    _pending_next_run.pop(job_id, None)
+    _pending_removals.add(job_id)
+    _pending_chats[job_id] = chat_id
+    return pending_write_count()
+
+
+def queue_delivery_log(
+    job_id: str, chat_id: int, scheduled: float, sent: float, outcome: str
+) -> int:
+    """Buffer a delivery log row for the next flush. Times are epoch seconds."""
+    if DELIVERY_LOG_DAYS > 0:
+        _pending_deliveries.append(
+            (job_id, chat_id, int(scheduled * 1000), int(sent * 1000), outcome)
+        )
+    return pending_write_count()
+
+
+def pending_write_count() -> int:
+    return len(_pending_next_run) + len(_pending_removals) + len(_pending_deliveries)
+
+
+def _restore_pending(updates, removals, deliveries, chats):
+    # Put a failed batch back, without clobbering anything queued meanwhile.
+    _pending_deliveries[:0] = deliveries
+    for job_id, next_run_time in updates.items():
+        if job_id not in _pending_removals:
+            _pending_next_run.setdefault(job_id, next_run_time)
+    _pending_removals.update(removals - _pending_next_run.keys())
+    for job_id in updates.keys() | removals:
+        _pending_chats.setdefault(job_id, chats[job_id])
+
+
+async def flush_pending_writes():
+    """Apply every buffered update, removal and log row, one transaction per shard."""
+    global _pending_next_run, _pending_removals, _pending_deliveries, _pending_chats
+    if not pending_write_count():
+        return
+    updates, removals = _pending_next_run, _pending_removals
+    deliveries, chats = _pending_deliveries, _pending_chats
+    _pending_next_run, _pending_removals, _pending_deliveries = {}, set(), []
+    _pending_chats = {}
+
+    batches: Dict[int, tuple] = {}
+
+    def batch(chat_id: int) -> tuple:
+        shard = shard_for(chat_id)
+        if shard not in batches:
+            batches[shard] = ({}, set(), [])
+        return batches[shard]
+
+    for job_id, next_run_time in updates.items():
+        batch(chats[job_id])[0][job_id] = next_run_time
+    for job_id in removals:
+        batch(chats[job_id])[1].add(job_id)
+    for delivery in deliveries:
+        batch(delivery[1])[2].append(delivery)
+    results = await asyncio.gather(
+        *(
+            _run(_apply_pending, *batch, shard=shard)
+            for shard, batch in batches.items()
+        ),
+        return_exceptions=True,
     )
-    rows = cursor.fetchall()
-    conn.close()
-    return (dict(row) for row in rows) if rows else None
+    errors = []
+    for shard_batch, result in zip(batches.values(), results):
+        if isinstance(result, BaseException):
+            _restore_pending(*shard_batch, chats)
+            errors.append(result)
+    if errors:
+        raise errors[0]
 
 
-def get_job_from_db(job_id: int):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT id, chat_id, user_id, message, interval, next_run_time FROM jobs WHERE id = ?",
-        (job_id,),
+def _with_pending(job: dict) -> Optional[dict]:
+    """Overlay unflushed writes so readers see the state they will produce."""
+    if job["id"] in _pending_removals:
+        return None
+    if job["id"] in _pending_next_run:
+        job["next_run_time"] = _pending_next_run[job["id"]]
+    return job
+
+
+async def get_jobs_page_from_db(
+    chat_id: int, cursor: int = 0, limit: int = 20, before: bool = False
+):
+    """Return up to `limit` jobs of a chat after (or before) seq `cursor`.
+
+    Rows come back in seq order with their seq, so callers can pass the
+    first or last one back as the cursor of the neighbouring page. One extra
+    row is read to tell whether another page follows: returns (jobs, has_more).
+    """
+    sql = _SELECT_CHAT_PAGE_BEFORE if before else _SELECT_CHAT_PAGE_AFTER
+    rows = await _run(
+        _fetchall, sql, (chat_id, cursor, limit + 1), shard=shard_for(chat_id)
     )
-    job = cursor.fetchone()
-    conn.close()
-    return dict(job) if job else None
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if before:
+        rows.reverse()
+    jobs = [job for job in map(_with_pending, map(dict, rows)) if job]
+    return jobs, has_more
+
+
+async def get_jobs_by_ids(job_ids: Iterable[str]) -> Dict[str, dict]:
+    """Fetch jobs by id with one query per shard; ids without a row are left out.
+
+    Ids do not say which chat they belong to, so every shard is asked, in
+    parallel; a shard without any of them answers from the primary key alone.
+    """
+    ids = json.dumps(list(job_ids))
+    jobs = {}
+    for rows in await _run_all(_fetchall, _SELECT_JOBS_BY_IDS, (ids,)):
+        for job in map(_with_pending, map(dict, rows)):
+            if job:
+                jobs[job["id"]] = job
+    return jobs
+
 
+async def _fetch_due_batch():
+    global _due_batch
+    batch, _due_batch = _due_batch, {}
+    try:
+        jobs = await get_jobs_by_ids(batch)
+    except Exception as e:
+        for future in batch.values():
+            if not future.done():
+                future.set_exception(e)
+        return
+    for job_id, future in batch.items():
+        if not future.done():
+            future.set_result(jobs.get(job_id))
 
-def load_jobs_from_db(application: Application, reminder_callback: JobCallback):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT id,chat_id, user_id, message, interval, next_run_time FROM jobs"
+
+def _start_due_fetch():
+    task = asyncio.create_task(_fetch_due_batch())
+    _due_fetches.add(task)
+    task.add_done_callback(_due_fetches.discard)
+
+
+async def get_due_job(job_id: str) -> Optional[dict]:
+    """Fetch one job by id, batched with the other jobs firing now; None if gone."""
+    future = _due_batch.get(job_id)
+    if future is None:
+        loop = asyncio.get_running_loop()
+        if not _due_batch:
+            loop.call_later(FIRE_BATCH_WINDOW, _start_due_fetch)
+        future = _due_batch[job_id] = loop.create_future()
+    return await asyncio.shield(future)
+
+
+async def prune_delivery_log() -> int:
+    """Drop the delivery tables older than DELIVERY_LOG_DAYS. Returns how many."""
+    oldest = clock.time() - DELIVERY_LOG_DAYS * 24 * 60 * 60
+    table = _delivery_table(int(oldest * 1000))
+    return max(await _run_all(_prune_deliveries, table))
+
+
+async def get_recent_deliveries(
+    chat_id: Optional[int] = None, limit: int = 20
+) -> List[dict]:
+    """Return the latest logged deliveries, newest first, of one chat or all."""
+    if chat_id is not None:
+        rows = await _run(_recent_deliveries, chat_id, limit, shard=shard_for(chat_id))
+        return [dict(row) for row in rows]
+    rows = [
+        row
+        for shard_rows in await _run_all(_recent_deliveries, None, limit)
+        for row in shard_rows
+    ]
+    if DB_SHARDS > 1:
+        rows.sort(key=lambda row: row["sent"], reverse=True)
+    return [dict(row) for row in rows[:limit]]
+
+
+async def set_coalesce_window(chat_id: int, window: Optional[float]):
+    """Store a chat's coalescing window in seconds; None turns coalescing off."""
+    await _run(
+        _execute_write,
+        _UPSERT_COALESCE_WINDOW,
+        (chat_id, window),
+        shard=shard_for(chat_id),
     )
-    rows = cursor.fetchall()
-    conn.close()
 
-    for row in rows:
-        job_id, chat_id, user_id, message, interval, next_run_time = row
-        next_run_time = datetime.fromisoformat(next_run_time)
-        now = datetime.now(timezone.utc)
-        if next_run_time < now:
-            if interval:
-                # Calculate the next valid run time for repeating jobs
-                intervals = {
-                    "daily": timedelta(days=1),
-                    "weekly": timedelta(weeks=1),
-                    "hourly": timedelta(hours=1),
-                }
-                missed_time = now - next_run_time
-                interval_delta = intervals[interval]
-                missed_intervals = (missed_time // interval_delta) + 1
-                next_run_time += missed_intervals * interval_delta
-                update_job_next_run_time(job_id, next_run_time.isoformat())
-            else:
-                # Remove non-repeating jobs with past run times
-                remove_job_from_db(job_id)
-                continue
-        if interval:
-            intervals = {
-                "daily": timedelta(days=1),
-                "weekly": timedelta(weeks=1),
-                "hourly": timedelta(hours=1),
-            }
-            application.job_queue.run_repeating(
+
+async def get_coalesce_windows() -> Dict[int, float]:
+    return {
+        row["chat_id"]: row["coalesce_window"]
+        for rows in await _run_all(_fetchall, _SELECT_COALESCE_WINDOWS)
+        for row in rows
+    }
+
+
+async def set_chat_timezone(chat_id: int, zone: Optional[str]):
+    """Store the time zone for a chat's cron rules; None means UTC."""
+    await _run(
+        _execute_write, _UPSERT_TIMEZONE, (chat_id, zone), shard=shard_for(chat_id)
+    )
+
+
+async def get_chat_timezone(chat_id: int) -> Optional[str]:
+    row = await _run(_fetchone, _SELECT_TIMEZONE, (chat_id,), shard=shard_for(chat_id))
+    return row["timezone"] if row else None
+
+
+async def claim_due_jobs(until: int, limit: int):
+    """Lease up to `limit` unleased jobs due before epoch ms `until` to WORKER_ID.
+
+    Each lease lasts until LEASE_DURATION after the job is due (or after now,
+    for overdue jobs); reminder_callback releases it by moving the job on or
+    removing it. Expired leases count as free, so jobs claimed by a worker
+    that died are claimed again by the next worker to look. With shards, each
+    one gives up to its share of `limit`.
+    """
+    now = int(clock.time() * 1000)
+    share = -(-limit // DB_SHARDS)
+    params = (WORKER_ID, now, int(LEASE_DURATION * 1000), until, now, share)
+    return [row for rows in await _run_all(_claim, _CLAIM_JOBS, params) for row in rows]
+
+
+def holds_lease(job: Optional[dict]) -> bool:
+    """Whether this worker still owns `job` long enough to fire it.
+
+    Only the first half of a lease is used, leaving the other half for the
+    write-behind flush that releases it, so a job never fires on two workers.
+    """
+    if not job or job["lease_owner"] != WORKER_ID:
+        return False
+    return job["lease_expires"] - LEASE_DURATION * 500 > clock.time() * 1000
+
+
+async def release_leases():
+    """Hand back every lease held by this worker, e.g. on shutdown."""
+    await _run_all(_execute_write, _UPDATE_RELEASE_LEASES, (WORKER_ID,))
+
+
+def loaded_until() -> int:
+    """Epoch ms up to which due jobs have been registered with the scheduler.
+
+    Jobs created with a next run time before this must be registered by their
+    handler; later ones are picked up by a future load_jobs_from_db call.
+    """
+    return _loaded_until
+
+
+async def schedule_jobs(
+    application: Application, reminder_callback: JobCallback, rows: List[tuple]
+):
+    """Register jobs rows with the scheduler, yielding between batches."""
+    for start in range(0, len(rows), _LOAD_BATCH):
+        for job_id, chat_id, user_id, _, _, next_run_time in rows[
+            start : start + _LOAD_BATCH
+        ]:
+            schedule_reminder(
+                application,
                 reminder_callback,
-                interval=intervals[interval],
-                first=(next_run_time - datetime.now(timezone.utc)).total_seconds(),
-                chat_id=chat_id,
-                user_id=user_id,
-                name=str(chat_id),
-                data=message,
+                job_id,
+                chat_id,
+                user_id,
+                from_epoch_ms(next_run_time),
             )
-        else:
-            application.job_queue.run_once(
+        await asyncio.sleep(0)
+
+
+async def recover_missed_jobs(now: int):
+    """Catch up the jobs due before epoch ms `now`, in one transaction per shard.
+
+    Repeating jobs move to their next run after now. One-shot jobs are dropped
+    or, with MISSED_ONESHOT_POLICY=late, rescheduled LATE_DELIVERY_RATE per
+    second from now, so they go out as a throttled burst through the normal
+    scheduler while the bot is already answering updates. Returns how many
+    repeating and one-shot jobs were affected.
+    """
+    spacing = None
+    if MISSED_ONESHOT_POLICY == "late":
+        spacing = max(int(1000 / LATE_DELIVERY_RATE), 1)
+    # Shards interleave their late reminders, so the rate holds overall.
+    results = await asyncio.gather(
+        *(
+            _run(
+                _recover,
+                now,
+                now + shard * (spacing or 0),
+                spacing and spacing * DB_SHARDS,
+                shard=shard,
+            )
+            for shard in range(DB_SHARDS)
+        )
+    )
+    caught_up = sum(shard_caught_up for shard_caught_up, _ in results)
+    missed = sum(shard_missed for _, shard_missed in results)
+    if caught_up or missed:
+        logger.info(
+            "Recovered missed reminders: %d repeating moved on, %d one-shot %s",
+            caught_up,
+            missed,
+            "dropped" if spacing is None else "rescheduled",
+        )
+    return caught_up, missed
+
+
+async def load_jobs_from_db(application: Application, reminder_callback: JobCallback):
+    """Register the jobs due before now + LOAD_HORIZON that are not loaded yet.
+
+    Only the slice after the previous horizon is read, in batches along
+    idx_jobs_due, so each call costs the size of one window rather than of the
+    whole table. The first call runs recover_missed_jobs first, for jobs that
+    went overdue while the bot was down. Shards are read in parallel. It is
+    run as a repeating job so the window keeps moving.
+    """
+    global _loaded_until
+    now = to_epoch_ms(clock.now())
+    if _loaded_until == 0:
+        await recover_missed_jobs(now)
+    until = now + int(LOAD_HORIZON * 1000)
+    since = _loaded_until
+    # Move the watermark before reading so handlers running meanwhile
+    # register their own jobs; schedule_reminder skips any we read as well.
+    _loaded_until = until
+    try:
+        # Next runs queued before the move were left to this load; write them
+        # first so the window read below sees them.
+        await flush_pending_writes()
+        await asyncio.gather(
+            *(
+                _load_window(application, reminder_callback, since, until, shard)
+                for shard in range(DB_SHARDS)
+            )
+        )
+    except BaseException:
+        # Leave the window to the next call, e.g. when the DB was locked for a
+        # backup; jobs registered meanwhile are skipped when it is read again.
+        _loaded_until = since
+        raise
+
+
+async def _load_window(
+    application: Application,
+    reminder_callback: JobCallback,
+    since: int,
+    until: int,
+    shard: int,
+):
+    cursor = (since, "")
+    while True:
+        rows = await _run(
+            _fetchall,
+            _SELECT_JOBS_WINDOW,
+            (*cursor, until, _LOAD_BATCH),
+            shard=shard,
+        )
+        for row in rows:
+            job_id, chat_id, user_id, _, next_run_time = row
+            schedule_reminder(
+                application,
                 reminder_callback,
-                next_run_time,
-                chat_id=chat_id,
-                user_id=user_id,
-                name=str(chat_id),
-                data=message,
+                job_id,
+                chat_id,
+                user_id,
+                from_epoch_ms(next_run_time),
             )
+        if len(rows) < _LOAD_BATCH:
+            break
+        cursor = (rows[-1]["next_run_time"], rows[-1]["id"])
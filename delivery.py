@@ -0,0 +1,341 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from telegram import Bot
+from telegram.constants import MessageLimit
+from telegram.error import (
+    BadRequest,
+    ChatMigrated,
+    Forbidden,
+    NetworkError,
+    RetryAfter,
+    TelegramError,
+)
+
+import clock
+from metrics import api_errors, delivery_lag
+from settings import (
+    DELIVERY_CONCURRENCY,
+    DELIVERY_GLOBAL_RATE,
+    DELIVERY_GROUP_RATE,
+    DELIVERY_MAX_RETRIES,
+    DELIVERY_PRIVATE_RATE,
+)
+from utils.helpers import pack_messages
+
+logger = logging.getLogger(__name__)
+
+# Seconds between sweeps for per-chat buckets that have refilled.
+_BUCKET_SWEEP_INTERVAL = 60
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, up to `capacity`."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a token is available (0 if one is available now)."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        """Whether the bucket has refilled, i.e. is as good as a new one."""
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class _Message:
+    __slots__ = ("chat_id", "text", "due", "attempts", "jobs")
+
+    def __init__(
+        self, chat_id: int, text: str, due: float, jobs: List[Tuple[str, float]]
+    ):
+        self.chat_id = chat_id
+        self.text = text
+        self.due = due
+        self.attempts = 0
+        # (job id, due time) of each reminder this message carries.
+        self.jobs = jobs
+
+
+class DeliveryQueue:
+    """Sends messages to Telegram at the highest rate the Bot API allows.
+
+    Messages are queued per chat and chats are served round-robin, so one busy
+    chat cannot starve the others. A global bucket keeps the bot under
+    Telegram's ~30 msg/s limit and a bucket per chat keeps groups under
+    ~20 msg/min and private chats under 1 msg/s. Each chat has at most one
+    message in flight, which preserves per-chat ordering. RetryAfter pauses all
+    sending for the requested time, like PTB's own rate limiter; network errors
+    are retried with exponential backoff. Messages to a group that was
+    upgraded to a supergroup are resent to the new chat; any other API error
+    drops the message.
+
+    Chats that opted into coalescing have their messages held for a short
+    window after the first one arrives and sent merged, split at Telegram's
+    message length limit.
+
+    `on_result`, if given, is called as on_result(job_id, chat_id, due,
+    sent_at, outcome) for every reminder once it was sent ("sent") or given
+    up on ("failed").
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        on_result: Optional[Callable[[str, int, float, float, str], None]] = None,
+    ):
+        self.bot = bot
+        self.on_result = on_result
+        self._global = TokenBucket(DELIVERY_GLOBAL_RATE, DELIVERY_GLOBAL_RATE)
+        # Per-chat buckets, dropped again once full and idle by _sweep_buckets.
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._next_sweep = time.monotonic() + _BUCKET_SWEEP_INTERVAL
+        self._queues: Dict[int, Deque[_Message]] = {}
+        # Chats with queued messages and nothing in flight, in serving order.
+        self._ready: Deque[int] = deque()
+        self._in_flight: Set[int] = set()
+        self._paused_until = 0.0
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(DELIVERY_CONCURRENCY)
+        self._tasks: Set[asyncio.Task] = set()
+        self._worker: Optional[asyncio.Task] = None
+        self._coalesce_windows: Dict[int, float] = {}
+        self._held: Dict[int, List[_Message]] = {}
+
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def set_coalesce_window(self, chat_id: int, window: Optional[float]):
+        """Merge a chat's messages arriving within `window` seconds (None: off)."""
+        if window:
+            self._coalesce_windows[chat_id] = window
+        else:
+            self._coalesce_windows.pop(chat_id, None)
+            self._release(chat_id)
+
+    def enqueue(
+        self,
+        chat_id: int,
+        text: str,
+        due: Optional[float] = None,
+        job_id: Optional[str] = None,
+    ):
+        """Queue `text` for `chat_id`. `due` is the epoch time it was meant to go out."""
+        due = clock.time() if due is None else due
+        message = _Message(chat_id, text, due, [(job_id, due)] if job_id else [])
+        window = self._coalesce_windows.get(chat_id)
+        if window:
+            held = self._held.get(chat_id)
+            if held is None:
+                held = self._held[chat_id] = []
+                asyncio.get_running_loop().call_later(window, self._release, chat_id)
+            held.append(message)
+            return
+        self._push(message)
+
+    def _release(self, chat_id: int):
+        """Queue a chat's held messages, merged into as few sends as possible."""
+        held = self._held.pop(chat_id, None)
+        if not held:
+            return
+        due = min(message.due for message in held)
+        texts = pack_messages(
+            (message.text for message in held), MessageLimit.MAX_TEXT_LENGTH
+        )
+        # The reminders are accounted to the first part of the merged text.
+        jobs = [job for message in held for job in message.jobs]
+        for text in texts:
+            self._push(_Message(chat_id, text, due, jobs))
+            jobs = []
+
+    def _push(self, message: _Message):
+        chat_id = message.chat_id
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = deque()
+            if chat_id not in self._in_flight:
+                self._ready.append(chat_id)
+        queue.append(message)
+        self._wakeup.set()
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # Group and channel ids are negative.
+            if chat_id < 0:
+                bucket = TokenBucket(DELIVERY_GROUP_RATE / 60, 3)
+            else:
+                bucket = TokenBucket(DELIVERY_PRIVATE_RATE, 1)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def _sweep_buckets(self, now: float):
+        """Forget the buckets of idle chats that have refilled completely.
+
+        A new bucket starts full, so dropping them changes no send times and
+        keeps the dict to the chats that sent recently instead of every chat
+        the bot ever reminded.
+        """
+        for chat_id, bucket in list(self._buckets.items()):
+            if (
+                chat_id not in self._queues
+                and chat_id not in self._in_flight
+                and bucket.full(now)
+            ):
+                del self._buckets[chat_id]
+        self._next_sweep = now + _BUCKET_SWEEP_INTERVAL
+
+    def _next_chat(self, now: float):
+        """Pop the first ready chat whose bucket has a token, or return the wait."""
+        wait = None
+        for _ in range(len(self._ready)):
+            chat_id = self._ready.popleft()
+            chat_wait = self._bucket(chat_id).wait_time(now)
+            if chat_wait == 0:
+                return chat_id, 0.0
+            self._ready.append(chat_id)
+            wait = chat_wait if wait is None else min(wait, chat_wait)
+        return None, wait
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            if now >= self._next_sweep:
+                self._sweep_buckets(now)
+            wait = max(self._paused_until - now, self._global.wait_time(now))
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            chat_id, wait = self._next_chat(now)
+            if chat_id is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._slots.acquire()
+            now = time.monotonic()
+            self._global.take(now)
+            self._bucket(chat_id).take(now)
+            message = self._queues[chat_id].popleft()
+            if not self._queues[chat_id]:
+                del self._queues[chat_id]
+            self._in_flight.add(chat_id)
+            task = asyncio.create_task(self._send(message))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, message: _Message):
+        chat_id = message.chat_id
+        try:
+            await self.bot.send_message(chat_id=message.chat_id, text=message.text)
+        except RetryAfter as e:
+            api_errors.inc(type(e).__name__)
+            logger.warning("Flood control hit, pausing delivery for %ss", e.retry_after)
+            self._paused_until = max(
+                self._paused_until, time.monotonic() + e.retry_after
+            )
+            self._retry(message)
+        except ChatMigrated as e:
+            api_errors.inc(type(e).__name__)
+            logger.warning(
+                "Chat %s moved to %s, resending there", chat_id, e.new_chat_id
+            )
+            message.chat_id = e.new_chat_id
+            self.retried += 1
+            self._push(message)
+        except (Forbidden, BadRequest) as e:
+            api_errors.inc(type(e).__name__)
+            self.failed += 1
+            logger.error("Dropping message to %s: %s", message.chat_id, e)
+            self._report(message, "failed")
+        except NetworkError as e:
+            api_errors.inc(type(e).__name__)
+            message.attempts += 1
+            if message.attempts > DELIVERY_MAX_RETRIES:
+                self.failed += 1
+                logger.error("Giving up on message to %s: %s", message.chat_id, e)
+                self._report(message, "failed")
+            else:
+                backoff = min(2**message.attempts, 60)
+                logger.warning(
+                    "Sending to %s failed (%s), retrying in %ss",
+                    message.chat_id,
+                    e,
+                    backoff,
+                )
+                await asyncio.sleep(backoff)
+                self._retry(message)
+        except TelegramError as e:
+            api_errors.inc(type(e).__name__)
+            self.failed += 1
+            logger.error("Dropping message to %s: %s", message.chat_id, e)
+            self._report(message, "failed")
+        else:
+            self.sent += 1
+            delivery_lag.observe(max(clock.time() - message.due, 0.0))
+            self._report(message, "sent")
+        finally:
+            self._in_flight.discard(chat_id)
+            if chat_id in self._queues:
+                self._ready.append(chat_id)
+            self._slots.release()
+            self._wakeup.set()
+
+    def _report(self, message: _Message, outcome: str):
+        if self.on_result is None:
+            return
+        now = clock.time()
+        for job_id, due in message.jobs:
+            self.on_result(job_id, message.chat_id, due, now, outcome)
+
+    def _retry(self, message: _Message):
+        """Put a message back at the head of its chat's queue."""
+        self.retried += 1
+        queue = self._queues.get(message.chat_id)
+        if queue is None:
+            queue = self._queues[message.chat_id] = deque()
+        queue.appendleft(message)
+
+    def start(self):
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10):
+        """Stop the worker, giving queued messages up to `timeout` seconds to drain."""
+        for chat_id in list(self._held):
+            self._release(chat_id)
+        deadline = time.monotonic() + timeout
+        while (len(self) or self._tasks) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        for task in list(self._tasks):
+            task.cancel()
+        if len(self):
+            logger.warning("Dropped %s undelivered messages on shutdown", len(self))
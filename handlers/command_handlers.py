@@ -1,39 +1,86 @@
+import io
 import logging
-from datetime import datetime, timedelta, timezone
+import os
+import re
+import tempfile
+from datetime import timedelta
+from html import escape
+from typing import List
+from uuid import uuid4
 from pprint import pprint
 
 from telegram import (
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
     Update,
 )
-from telegram.constants import ParseMode
+from telegram.constants import MessageLimit, ParseMode
+from telegram.error import TelegramError
 from telegram.ext import (
+    Application,
     ContextTypes,
 )
 
+import clock
 from db import (
-    get_job_from_db,
-    get_jobs_from_db,
-    remove_job_from_db,
+    claim_due_jobs,
+    export_jobs,
+    flush_pending_writes,
+    get_chat_timezone,
+    get_due_job,
+    get_jobs_page_from_db,
+    get_recent_deliveries,
+    holds_lease,
+    import_jobs,
+    load_jobs_from_db,
+    loaded_until,
+    prune_delivery_log,
+    queue_job_removal,
+    queue_next_run_update,
+    remove_chat_jobs_from_db,
     save_job_to_db,
-    update_job_next_run_time,
+    schedule_jobs,
+    set_chat_timezone,
+    set_coalesce_window,
 )
 from utils.decorators import (
     mygroup_admins_or_personal_only,
+    profiled,
     restricted,
     send_action,
     show_help_for_set,
+    timed,
 )
-from utils.helpers import format_time_left
-
-# Enable logging
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+from metrics import (
+    api_errors,
+    db_query_latency,
+    delivery_lag,
+    handler_latency,
+    job_queue_size,
+    scheduler_lag,
+    update_queue_size,
+)
+from settings import (
+    CLAIM_BATCH,
+    CLAIM_INTERVAL,
+    COALESCE_WINDOW,
+    HTTP_MEDIA_TIMEOUT,
+    REMINDERS_PAGE_SIZE,
+    SCHEDULER_MODE,
+    WRITE_BEHIND_MAX_PENDING,
 )
-logging.getLogger("httpx").setLevel(logging.WARNING)
+from recurrence import compile_rule, parse_zone
+from scheduling import schedule_reminder, unschedule_reminder
+from transfer import FORMATS, ImportStats, guess_format, write_jobs
+from utils.cache import chat_admins, chat_members, get_chat_users
+from utils.helpers import format_time_left, from_epoch_ms, to_epoch_ms
+from utils.profiling import profiler
 
 logger = logging.getLogger(__name__)
 
 
+@timed
+@profiled
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /start is issued."""
 
@@ -47,6 +94,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
 
 
+async def track_chat_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Drop cached admin and member data of a chat when its membership changes."""
+    chat_member = update.chat_member or update.my_chat_member
+    chat_admins.invalidate(chat_member.chat.id)
+    chat_members.invalidate((chat_member.chat.id, chat_member.new_chat_member.user.id))
+
+
 def remove_job_if_exists(name: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """Remove job with given name. Returns whether job was removed."""
 
@@ -61,28 +115,103 @@ def remove_job_if_exists(name: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
     return True
 
 
+@timed
+@profiled
 async def reminder_callback(context: ContextTypes.DEFAULT_TYPE, *args):
-    job = context.job
-    chat_id = job.chat_id
-    message = job.data
-    job_id = job.job.id
-    db_job = get_job_from_db(job_id)
-
-    await context.bot.send_message(chat_id=chat_id, text=message)
-
-    if db_job and db_job["interval"]:
-        interval: str = db_job["interval"]
-        intervals = {
-            "daily": timedelta(days=1),
-            "weekly": timedelta(weeks=1),
-            "hourly": timedelta(hours=1),
-        }
-        next_run_time = (datetime.now(timezone.utc) + intervals[interval]).isoformat()
-        update_job_next_run_time(job_id, next_run_time)
+    await fire_reminder(context.application, context.job.job.id)
+
+
+@profiled
+async def fire_reminder(application: Application, job_id: str):
+    """Send a due reminder and queue its bookkeeping.
+
+    Schedulers only hold the job id; the row is read with get_due_job, so
+    reminders due together cost one query. A reminder without a row was
+    canceled and is not sent.
+    """
+    db_job = await get_due_job(job_id)
+    if not db_job:
+        return
+    if SCHEDULER_MODE == "leased" and not holds_lease(db_job):
+        # Claimed again by another worker after this one stalled.
+        logger.warning("Not firing job %s, its lease is gone", job_id)
+        return
+    chat_id, message = db_job["chat_id"], db_job["message"]
+
+    due = db_job["next_run_time"] / 1000
+    scheduler_lag.observe(max(clock.time() - due, 0.0))
+    application.bot_data["delivery"].enqueue(chat_id, message, due, job_id)
+
+    if db_job["interval"]:
+        # The next run follows the one just fired, not the time it fired at,
+        # so late fires do not make the reminder drift.
+        next_run_time = compile_rule(db_job["interval"]).next_after(
+            db_job["next_run_time"], int(clock.time() * 1000)
+        )
+        pending = queue_next_run_update(job_id, chat_id, next_run_time)
+        if SCHEDULER_MODE == "local" and next_run_time < loaded_until():
+            schedule_reminder(
+                application,
+                reminder_callback,
+                job_id,
+                chat_id,
+                db_job["user_id"],
+                from_epoch_ms(next_run_time),
+            )
     else:
-        remove_job_from_db(job_id)
+        pending = queue_job_removal(job_id, chat_id)
+
+    if pending >= WRITE_BEHIND_MAX_PENDING:
+        await flush_pending_writes()
+
+
+def fire_reminders(application: Application, job_ids: List[str]):
+    """Fire the reminders the timing wheel found due, each in its own task.
+
+    The tasks start together, so their rows are fetched in one batch.
+    """
+    for job_id in job_ids:
+        application.create_task(fire_reminder(application, job_id))
 
 
+async def refill_jobs(context: ContextTypes.DEFAULT_TYPE):
+    """Periodic job that registers the next window of jobs from the DB."""
+    await load_jobs_from_db(context.application, reminder_callback)
+
+
+async def claim_jobs(context: ContextTypes.DEFAULT_TYPE):
+    """Periodic job that leases the jobs due before the next claim and queues them.
+
+    Used instead of refill_jobs with SCHEDULER_MODE=leased. Every job is
+    registered as a one-off run: once it fires, reminder_callback moves it on
+    and releases it, and whichever worker claims next fires the next run.
+    """
+    now = clock.now()
+    until = to_epoch_ms(now) + int(CLAIM_INTERVAL * 1000)
+    for row in await claim_due_jobs(until, CLAIM_BATCH):
+        schedule_reminder(
+            context.application,
+            reminder_callback,
+            row["id"],
+            row["chat_id"],
+            row["user_id"],
+            # Overdue jobs, e.g. from a crashed worker, fire right away.
+            max(from_epoch_ms(row["next_run_time"]), now),
+        )
+
+
+async def flush_db_writes(context: ContextTypes.DEFAULT_TYPE):
+    """Periodic job that flushes reminder bookkeeping queued by reminder_callback."""
+    await flush_pending_writes()
+
+
+async def prune_deliveries(context: ContextTypes.DEFAULT_TYPE):
+    """Periodic job that drops delivery history older than DELIVERY_LOG_DAYS."""
+    await prune_delivery_log()
+
+
+@timed
+@profiled
 @mygroup_admins_or_personal_only
 async def set_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # chat_id = update.effective_message.chat_id
@@ -124,7 +253,7 @@ async def set_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         time_kwargs = {time_units[time_unit_key]: time_value}
-        scheduled_time = datetime.now(timezone.utc) + timedelta(**time_kwargs)
+        scheduled_time = clock.now() + timedelta(**time_kwargs)
 
         time_message = format_time_left(scheduled_time)
 
@@ -140,14 +269,22 @@ async def set_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         # job_removed = remove_job_if_exists(str(chat_id), context)
 
-        job = context.job_queue.run_once(
-            reminder_callback,
-            scheduled_time,
-            chat_id=chat_id,
-            user_id=user.id,
-            name=str(chat_id),
-            data=message,
+        job_id = uuid4().hex
+        # save the job to the db, before it can fire
+        await save_job_to_db(
+            job_id, chat_id, user.id, message, None, to_epoch_ms(scheduled_time)
         )
+        # Jobs past the loaded window are registered later by load_jobs_from_db;
+        # in leased mode every job is left for claim_jobs.
+        if SCHEDULER_MODE == "local" and to_epoch_ms(scheduled_time) < loaded_until():
+            schedule_reminder(
+                context.application,
+                reminder_callback,
+                job_id,
+                chat_id,
+                user.id,
+                scheduled_time,
+            )
         # print(job.job, "job instance")
         # print(job.job.id)
         # text = "Timer successfully set!"
@@ -158,17 +295,14 @@ async def set_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # await update.effective_message.reply_text(text)
         # print(len(context.job_queue.jobs()))
         # job = context.job_queue.run_once(callback_minute, interval=5, first=5)
-        context.chat_data["job"] = job
-        # save the job to the db
-        save_job_to_db(
-            job.job.id, chat_id, user.id, message, None, scheduled_time.isoformat()
-        )
 
     except (IndexError, ValueError) as e:
         logger.error("Error setting message: %s", e)
         await update.message.reply_text("Usage: /set <message>")
 
 
+@timed
+@profiled
 @mygroup_admins_or_personal_only
 async def remind(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger = logging.getLogger("telegram.ext.JobQueue")
@@ -180,122 +314,454 @@ async def remind(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if update.message.reply_to_message
         else None
     )
-    message = reply if reply else " ".join(context.args[:-1])
+    # The rule is the last word, or everything from the last "cron" on.
+    words = [arg.lower() for arg in context.args]
+    split = len(words) - 1
+    if "cron" in words:
+        split -= words[::-1].index("cron")
+    message = reply if reply else " ".join(context.args[:split])
     # pprint(reply)
     # print("________________")
     try:
-        interval = context.args[-1].lower()
-        intervals = {
-            "daily": timedelta(days=1),
-            "weekly": timedelta(weeks=1),
-            "hourly": timedelta(hours=1),
-        }
-        if interval not in intervals:
-            await update.message.reply_text(
-                "Invalid interval. Use daily, weekly, or hourly."
-            )
-            return
-
+        rule = compile_rule(
+            " ".join(context.args[split:]), await get_chat_timezone(chat_id)
+        )
+    except ValueError as e:
+        logger.error("Error setting reminder: %s", e)
         await update.message.reply_text(
-            f"Message will be sent {interval} starting now."
+            "Invalid interval. Use hourly, daily, weekly, every N minutes, hours,"
+            " days or weeks (e.g. 90m, 2d) or cron &lt;min&gt; &lt;hour&gt;"
+            " &lt;day&gt; &lt;month&gt; &lt;weekday&gt;, e.g. cron 0 9 * * mon-fri.\n"
+            "Usage: /remind &lt;message&gt; &lt;interval&gt;",
+            parse_mode=ParseMode.HTML,
         )
+        return
 
-        logger.info(
-            "User %s set a reminder(%s) to be sent %s",
-            user.first_name,
-            message,
-            interval,
+    # Fixed intervals send the first reminder right away, cron rules on
+    # their first matching minute.
+    now = to_epoch_ms(clock.now())
+    if rule.period_ms:
+        next_run_time = now
+        await update.message.reply_text(
+            f"Message will be sent {rule.describe()} starting now."
+        )
+    else:
+        next_run_time = rule.next_after(now, now)
+        await update.message.reply_text(
+            f"Message will be sent {rule.describe()}, first in"
+            f" {format_time_left(from_epoch_ms(next_run_time)).strip()}."
         )
 
-        job = context.job_queue.run_repeating(
+    logger.info(
+        "User %s set a reminder(%s) to be sent %s",
+        user.first_name,
+        message,
+        rule.text,
+    )
+
+    job_id = uuid4().hex
+    # save the reminder job to the db, before it can fire
+    await save_job_to_db(job_id, chat_id, user.id, message, rule.text, next_run_time)
+    if SCHEDULER_MODE == "local" and next_run_time < loaded_until():
+        schedule_reminder(
+            context.application,
             reminder_callback,
-            interval=intervals[interval],
-            first=0,
-            chat_id=chat_id,
-            user_id=user.id,
-            name=str(chat_id),
-            data=message,
+            job_id,
+            chat_id,
+            user.id,
+            from_epoch_ms(next_run_time),
         )
-        # print(len(context.job_queue.jobs()))
-        context.chat_data["job"] = job
-        # save the reminder job to the db
-        next_run_time = (datetime.now(timezone.utc) + intervals[interval]).isoformat()
-        save_job_to_db(job.job.id, chat_id, user.id, message, interval, next_run_time)
 
-    except (IndexError, ValueError) as e:
-        logger.error("Error setting reminder: %s", e)
-        await update.message.reply_text("Usage: /remind <message> <interval>")
 
+async def _reminders_page(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    cursor: int = 0,
+    offset: int = 0,
+    before: bool = False,
+):
+    """Render one page of a chat's reminders with next/prev buttons.
+
+    `cursor` is the seq the page starts after (or ends before) and `offset`
+    is the position of the page's first reminder, which tells whether there
+    is a previous page. Reminders are numbered by seq, which /cancel takes
+    and which is never reused or shifted when other reminders go away. Returns
+    (text, reply_markup), or None if empty.
+    """
+    jobs, has_more = await get_jobs_page_from_db(
+        chat_id, cursor, REMINDERS_PAGE_SIZE, before
+    )
+    if not jobs:
+        return None
+    users = await get_chat_users(context.bot, chat_id, (job["user_id"] for job in jobs))
 
+    text = "Reminders:\n"
+    shown = 0
+    for job in jobs:
+        user = users[job["user_id"]]
+        next_run_time = from_epoch_ms(job["next_run_time"])
+        row = f"#{job['seq']}. <a href='tg://user?id='>{escape(job['message'][:200])} </a> - <i>{format_time_left(next_run_time)} left - {user.mention_html()}</i>\n"
+        # Rows that would take the reply over Telegram's limit go to the
+        # next page; counting the markup as well keeps on the safe side.
+        if shown and len(text) + len(row) > MessageLimit.MAX_TEXT_LENGTH:
+            break
+        text += row
+        shown += 1
+    if shown < len(jobs):
+        jobs, has_more = jobs[:shown], True
+
+    buttons = []
+    if offset > 0:
+        prev_offset = max(offset - REMINDERS_PAGE_SIZE, 0)
+        buttons.append(
+            InlineKeyboardButton(
+                "« Prev", callback_data=f"all:prev:{jobs[0]['seq']}:{prev_offset}"
+            )
+        )
+    # Paging back, the page we came from still follows this one.
+    if has_more or before:
+        next_offset = offset + len(jobs)
+        buttons.append(
+            InlineKeyboardButton(
+                "Next »", callback_data=f"all:next:{jobs[-1]['seq']}:{next_offset}"
+            )
+        )
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+@timed
+@profiled
 async def view_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    _jobs = context.job_queue.get_jobs_by_name(str(chat_id))
-    jobs = get_jobs_from_db(chat_id)
-    # print(list(jobs), "current jobs")
-    # is it necessary to get jobs from db?
-    #  we have the jobs in the job queue
-    if not jobs:
+    page = await _reminders_page(context, chat_id)
+    if not page:
         await update.message.reply_text("No reminders set.")
         return
-    text = "Reminders:\n"
+    text, reply_markup = page
+    await update.message.reply_text(
+        text, parse_mode=ParseMode.HTML, reply_markup=reply_markup
+    )
 
-    for i, job in enumerate(jobs):
-        # job = job
-        print(job, "single job")
-        chat_member = await context.bot.get_chat_member(chat_id, job["user_id"])
-        user = chat_member.user
-        # print(job.next_t)
-        next_run_time = datetime.fromisoformat(job["next_run_time"])
-        text += f"#{i}. <a href='tg://user?id='>{str(job['message'])} </a> - <i>{format_time_left(next_run_time)} left - {user.mention_html()}</i>\n"
-    await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+
+@timed
+@profiled
+async def view_reminders_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the next/prev buttons of /all."""
+    query = update.callback_query
+    await query.answer()
+    _, direction, cursor, offset = query.data.split(":")
+    page = await _reminders_page(
+        context,
+        update.effective_chat.id,
+        int(cursor),
+        int(offset),
+        before=direction == "prev",
+    )
+    if not page:
+        await query.edit_message_text("No reminders set.")
+        return
+    text, reply_markup = page
+    await query.edit_message_text(
+        text, parse_mode=ParseMode.HTML, reply_markup=reply_markup
+    )
 
 
+@timed
+@profiled
 @mygroup_admins_or_personal_only
 async def cancel_job(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Cancel reminders by the #numbers /all shows: one, several or all."""
     logger = logging.getLogger("telegram.ext.JobQueue")
     chat_id = update.effective_chat.id
+    # Ids may be separated by spaces, commas or both: /cancel 1 2, /cancel 1,2.
+    targets = [
+        target.lstrip("#")
+        for target in re.split(r"[\s,]+", " ".join(context.args).lower())
+        if target
+    ]
+    try:
+        if not targets:
+            raise ValueError("no reminder given")
+        if targets == ["all"]:
+            seqs = None
+        else:
+            seqs = list(dict.fromkeys(int(target) for target in targets))
+    except ValueError as e:
+        logger.error("Error canceling job: %s", e)
+        await update.message.reply_text(
+            "Usage: /cancel <id>, /cancel <id id ...> or /cancel all"
+        )
+        return
+
+    deleted = await remove_chat_jobs_from_db(chat_id, seqs)
+    # Jobs past the loaded window are only in the DB, not the scheduler.
+    for job_id in deleted.values():
+        unschedule_reminder(context.application, job_id)
+
+    if not deleted:
+        text = "No reminders set." if seqs is None else "Invalid job ID."
+    elif len(deleted) == 1:
+        text = "Reminder canceled."
+    else:
+        text = f"{len(deleted)} reminders canceled."
+    missing = [f"#{seq}" for seq in seqs or () if seq not in deleted]
+    if deleted and missing:
+        text += f" Not found in this chat: {', '.join(missing)}."
+    elif len(missing) > 1:
+        text = f"Invalid job IDs: {', '.join(missing)}."
+    await update.message.reply_text(text)
+
+
+@timed
+@profiled
+@mygroup_admins_or_personal_only
+async def coalesce(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Turn merging of reminders that fire together on or off for this chat."""
+    chat_id = update.effective_chat.id
+    try:
+        setting = context.args[0].lower()
+        if setting == "off":
+            window = None
+        elif setting == "on":
+            window = COALESCE_WINDOW
+        else:
+            window = float(setting)
+            if window <= 0:
+                raise ValueError("window must be positive")
+    except (IndexError, ValueError) as e:
+        logger.error("Error setting coalescing: %s", e)
+        await update.message.reply_text("Usage: /coalesce <on|off|seconds>")
+        return
+
+    await set_coalesce_window(chat_id, window)
+    context.bot_data["delivery"].set_coalesce_window(chat_id, window)
+    if window:
+        await update.message.reply_text(
+            f"Reminders due within {window:g}s of each other will be sent as one message."
+        )
+    else:
+        await update.message.reply_text("Reminders will be sent one by one.")
+
+
+@timed
+@profiled
+@mygroup_admins_or_personal_only
+async def set_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show or set the time zone of this chat's cron reminders."""
+    chat_id = update.effective_chat.id
+    if not context.args:
+        zone = await get_chat_timezone(chat_id) or "UTC"
+        await update.message.reply_text(
+            f"Cron reminders here follow {zone} time. Usage: /timezone <zone>"
+        )
+        return
     try:
-        job_id = context.args[0]
-        jobs = context.job_queue.get_jobs_by_name(str(chat_id))
-        db_jobs = get_jobs_from_db(chat_id)
+        zone = parse_zone(context.args[0]).key
+    except ValueError as e:
+        logger.error("Error setting time zone: %s", e)
+        await update.message.reply_text(
+            "Unknown time zone. Use a name like Europe/Berlin or UTC."
+        )
+        return
+
+    await set_chat_timezone(chat_id, None if zone == "UTC" else zone)
+    await update.message.reply_text(
+        f"New cron reminders here will follow {zone} time; existing ones keep"
+        " theirs."
+    )
+
 
-        if not jobs or not db_jobs:
+@timed
+@profiled
+@restricted
+async def export_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send this chat's reminders (or all, with "all") as a JSON Lines or CSV file."""
+    args = [arg.lower() for arg in context.args]
+    fmt = next((arg for arg in args if arg in FORMATS), "jsonl")
+    chat_id = None if "all" in args else update.effective_chat.id
+    # Rows go from the DB cursor to a temporary file, not into memory.
+    with tempfile.TemporaryFile() as f:
+        out = io.TextIOWrapper(f, encoding="utf-8", newline="")
+        count = await export_jobs(lambda rows: write_jobs(rows, out, fmt), chat_id)
+        out.flush()
+        out.detach()
+        if not count:
             await update.message.reply_text("No reminders set.")
             return
+        f.seek(0)
+        await update.message.reply_document(
+            f, filename=f"reminders.{fmt}", caption=f"{count} reminders"
+        )
 
-        if int(job_id) >= len(jobs):
-            await update.message.reply_text("Invalid job ID.")
-            return
-        # get the job from db list using the index from telegram
-        db_job = next(
-            (job for idx, job in enumerate(db_jobs) if idx == int(job_id)), None
+
+@timed
+@profiled
+@restricted
+async def import_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Add reminders from a JSON Lines or CSV document.
+
+    The document is either sent with /import as its caption or replied to
+    with /import.
+    """
+    message = update.message
+    document = message.document or (
+        message.reply_to_message and message.reply_to_message.document
+    )
+    if not document:
+        await message.reply_text(
+            "Send a .jsonl or .csv file with /import as its caption, or reply"
+            " to one with /import."
         )
-        job = jobs[int(job_id)]
+        return
+
+    file = await document.get_file()
+    data = await file.download_as_bytearray(read_timeout=HTTP_MEDIA_TIMEOUT)
+    stats = ImportStats()
+    try:
+        rows = stats.parse(
+            io.StringIO(data.decode("utf-8-sig"), newline=""),
+            guess_format(document.file_name or ""),
+        )
+        # Jobs due in the window already loaded must be registered here;
+        # later ones are picked up by load_jobs_from_db or claim_jobs.
+        register_until = loaded_until() if SCHEDULER_MODE == "local" else 0
+        inserted, due = await import_jobs(rows, register_until)
+    except (UnicodeDecodeError, ValueError) as e:
+        logger.error("Error importing reminders: %s", e)
+        await message.reply_text(f"Nothing imported: {e}")
+        return
+    await schedule_jobs(context.application, reminder_callback, due)
+    await message.reply_text(
+        f"Imported {inserted} of {stats.read} reminders"
+        f" ({stats.expired} expired, {stats.read - stats.expired - inserted}"
+        " already present)."
+    )
+
+
+def _format_histogram(histogram, *labels: str) -> str:
+    return (
+        f"{histogram.count(*labels)}x, mean {histogram.mean(*labels) * 1000:.1f} ms,"
+        f" p99 \u2264 {histogram.quantile(0.99, *labels) * 1000:g} ms"
+    )
+
 
-        db_job_id = db_job["id"]
-        if not db_job:
-            await update.message.reply_text("No reminder found.")
+@restricted
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin-only summary of the metrics also served on METRICS_PORT."""
+    delivery = context.bot_data["delivery"]
+    lines = ["Handlers:"]
+    for (handler,) in sorted(handler_latency.series):
+        lines.append(f"  {handler}: {_format_histogram(handler_latency, handler)}")
+    lines += [
+        f"Reminder lag: {_format_histogram(scheduler_lag)}",
+        f"Delivery lag: {_format_histogram(delivery_lag)}",
+        f"Delivery: {delivery.sent} sent, {delivery.failed} failed,"
+        f" {delivery.retried} retried, {len(delivery)} queued",
+        f"Scheduled: {job_queue_size.value} jobs",
+        f"Updates: {update_queue_size.value} pending",
+        "Slowest DB queries:",
+    ]
+    slowest = sorted(
+        db_query_latency.series.items(), key=lambda item: item[1][1], reverse=True
+    )
+    for (query,), _ in slowest[:5]:
+        lines.append(f"  {query}: {_format_histogram(db_query_latency, query)}")
+    errors = ", ".join(
+        f"{error}: {int(n)}" for (error,), n in api_errors.values.items()
+    )
+    lines.append(f"API errors: {errors or 'none'}")
+    await update.message.reply_text("\n".join(lines))
+
+
+@restricted
+async def deliveries(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin-only list of this chat's latest deliveries, or every chat's with "all"."""
+    chat_id = (
+        None if "all" in map(str.lower, context.args) else update.effective_chat.id
+    )
+    rows = await get_recent_deliveries(chat_id, REMINDERS_PAGE_SIZE)
+    if not rows:
+        await update.message.reply_text("No deliveries logged.")
+        return
+    lines = []
+    for row in rows:
+        late = max(row["sent"] - row["scheduled"], 0) / 1000
+        line = (
+            f"{from_epoch_ms(row['sent']):%Y-%m-%d %H:%M:%S} UTC {row['outcome']},"
+            f" {late:.1f}s late, job {row['job_id'][:8]}"
+        )
+        if chat_id is None:
+            line += f", chat {row['chat_id']}"
+        lines.append(line)
+    await update.message.reply_text("\n".join(lines))
+
+
+@restricted
+async def profiling(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin-only switch for profiling slow calls, and access to the profiles.
+
+    /profile on|off toggles it, /profile <seconds> sets the slow-call
+    threshold (and turns it on) and /profile last sends the latest profile.
+    """
+    arg = context.args[0].lower() if context.args else ""
+    if arg == "last":
+        files = profiler.files()
+        if not files:
+            await update.message.reply_text("No profiles saved.")
             return
-        job.schedule_removal()
-        remove_job_from_db(db_job_id)
-        await update.message.reply_text("Reminder canceled.")
+        with open(files[-1], "rb") as f:
+            await update.message.reply_document(
+                f,
+                filename=os.path.basename(files[-1]),
+                caption="Open with python -m pstats.",
+            )
         return
+    if arg in ("on", "off"):
+        profiler.enabled = arg == "on"
+    elif arg:
+        try:
+            profiler.threshold = float(arg)
+        except ValueError:
+            await update.message.reply_text(
+                "Usage: /profile [on|off|<threshold seconds>|last]"
+            )
+            return
+        profiler.enabled = True
+    sampled = ""
+    if profiler.sample_rate:
+        sampled = f" and {profiler.sample_rate:.0%} of the rest"
+    await update.message.reply_text(
+        f"Profiling is {'on' if profiler.enabled else 'off'}: saving calls over"
+        f" {profiler.threshold:g}s{sampled}. {len(profiler.files())} of at most"
+        f" {profiler.keep} profiles saved."
+    )
 
-    except (IndexError, ValueError) as e:
-        logger.error("Error canceling job: %s", e)
-        await update.message.reply_text("Usage: /cancel <job_id>")
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Count Bot API errors raised by handlers and jobs, then log the error."""
+    if isinstance(context.error, TelegramError):
+        api_errors.inc(type(context.error).__name__)
+    logger.error("Exception while handling an update:", exc_info=context.error)
 
 
+@timed
+@profiled
 @show_help_for_set
 async def help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "<b>Commands:</b>\n"
         "/start - Start the bot\n"
         "/set &lt;message&gt; &lt;time&gt; - Set a message to be sent later (e.g., /set Hello 10m)\n"
-        "/remind &lt;message&gt; &lt;interval&gt; - Set a recurring reminder (e.g., /remind Hello daily)\n"
+        "/remind &lt;message&gt; &lt;interval&gt; - Set a recurring reminder: hourly, daily, weekly, 90m, 2d or cron &lt;min&gt; &lt;hour&gt; &lt;day&gt; &lt;month&gt; &lt;weekday&gt; (e.g., /remind Hello daily, /remind Standup cron 0 9 * * mon-fri)\n"
         "/help - Display this message\n"
         "/all - View all reminders\n"
-        "/cancel &lt;job_id&gt; - Cancel a reminder by its ID\n",
+        "/export [csv] [all] - Download this chat's (or all) reminders\n"
+        "/import - Add reminders from a .jsonl or .csv file sent with it\n"
+        "/cancel &lt;id&gt; - Cancel a reminder by its #number in /all; takes several ids or all too\n"
+        "/coalesce &lt;on|off|seconds&gt; - Merge reminders that fire together\n"
+        "/timezone [zone] - Show or set the time zone for cron reminders (e.g., /timezone Europe/Berlin)\n"
+        "/deliveries [all] - Show the latest reminders sent here (or anywhere)\n"
+        "/profile [on|off|&lt;seconds&gt;|last] - Profile slow commands and reminders\n",
         parse_mode=ParseMode.HTML,
     )
 
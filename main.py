@@ -1,25 +1,137 @@
+import asyncio
+from typing import Optional
+
+import httpx
 from telegram import (
     Update,
 )
 from telegram.ext import (
     Application,
+    CallbackQueryHandler,
+    ChatMemberHandler,
     CommandHandler,
+    MessageHandler,
+    filters,
 )
+from telegram.request import HTTPXRequest
 
-from db import init_db, load_jobs_from_db
+from db import (
+    close_db,
+    flush_pending_writes,
+    get_coalesce_windows,
+    init_db,
+    queue_delivery_log,
+    release_leases,
+)
+from delivery import DeliveryQueue
 from handlers.command_handlers import (
     cancel_job,
+    claim_jobs,
+    coalesce,
+    deliveries,
+    error_handler,
+    export_reminders,
+    fire_reminders,
+    flush_db_writes,
     help,
+    import_reminders,
+    profiling,
+    prune_deliveries,
+    refill_jobs,
     remind,
-    reminder_callback,
     set_msg,
+    set_timezone,
     start,
+    stats,
+    track_chat_members,
     view_reminders,
+    view_reminders_page,
+)
+from metrics import (
+    delivery_queue_size,
+    job_queue_size,
+    start_metrics_server,
+    update_queue_size,
 )
-from settings import BOT_TOKEN
+from scheduling import scheduled_count, start_scheduler, stop_scheduler
+from settings import (
+    BOT_TOKEN,
+    CLAIM_INTERVAL,
+    DELIVERY_LOG_DAYS,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_KEEPALIVE,
+    HTTP_MEDIA_TIMEOUT,
+    HTTP_POOL_SIZE,
+    HTTP_POOL_TIMEOUT,
+    HTTP_READ_TIMEOUT,
+    HTTP_VERSION,
+    HTTP_WRITE_TIMEOUT,
+    LOAD_REFILL_INTERVAL,
+    METRICS_HOST,
+    METRICS_PORT,
+    SCHEDULER_MODE,
+    UPDATE_CONCURRENCY,
+    UPDATE_MAX_PENDING,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PATH,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET,
+    WEBHOOK_URL,
+    WRITE_BEHIND_INTERVAL,
+)
+from update_processor import ChatOrderedUpdateProcessor
+from utils.logs import setup_logging, stop_logging
+
+# Only the update types the registered handlers consume; Telegram does not
+# send chat_member updates unless they are asked for explicitly.
+ALLOWED_UPDATES = [
+    Update.MESSAGE,
+    Update.EDITED_MESSAGE,
+    Update.CALLBACK_QUERY,
+    Update.CHAT_MEMBER,
+    Update.MY_CHAT_MEMBER,
+]
 
 
 async def post_init(application: Application):
+    await init_db()
+    # Reminders are sent through a rate-limited queue, not straight to the bot.
+    delivery = DeliveryQueue(application.bot, on_result=queue_delivery_log)
+    for chat_id, window in (await get_coalesce_windows()).items():
+        delivery.set_coalesce_window(chat_id, window)
+    delivery.start()
+    application.bot_data["delivery"] = delivery
+    delivery_queue_size.collect = lambda: len(delivery)
+    update_queue_size.collect = lambda: (
+        application.update_queue.qsize() + len(application.update_processor)
+    )
+    start_scheduler(application, lambda job_ids: fire_reminders(application, job_ids))
+    job_queue_size.collect = lambda: scheduled_count(application)
+    if METRICS_PORT:
+        application.bot_data["metrics_server"] = await start_metrics_server(
+            METRICS_HOST, METRICS_PORT
+        )
+    # Jobs are loaded in the background, one window at a time, so polling
+    # starts right away however large the DB is. In leased mode the windows
+    # are short and claimed, so that several processes can share the DB.
+    # An interval job whose first run is "now" only starts one interval later
+    # once the scheduler is running, so the first window is loaded by its own
+    # one-off job.
+    if SCHEDULER_MODE == "leased":
+        load, interval = claim_jobs, CLAIM_INTERVAL
+    else:
+        load, interval = refill_jobs, LOAD_REFILL_INTERVAL
+    application.job_queue.run_once(load, 0, name=load.__name__)
+    application.job_queue.run_repeating(
+        load, interval=interval, first=interval, name=load.__name__
+    )
+    application.job_queue.run_repeating(
+        flush_db_writes, interval=WRITE_BEHIND_INTERVAL, name="flush_db_writes"
+    )
+    if DELIVERY_LOG_DAYS > 0:
+        application.job_queue.run_repeating(
+            prune_deliveries, interval=60 * 60, first=60, name="prune_deliveries"
+        )
     await application.bot.set_my_commands(
         [
             ("start", "Start the bot"),
@@ -27,27 +139,125 @@ async def post_init(application: Application):
             ("remind", "Set a recurring reminder"),
             ("help", "Display this message"),
             ("all", "View all reminders"),
-            ("cancel", "Cancel a reminder by job ID"),
+            ("cancel", "Cancel reminders by ID, or all of them"),
+            ("coalesce", "Merge reminders that fire at the same time"),
+            ("timezone", "Show or set the time zone for cron reminders"),
         ]
     )
 
 
-def main():
-    """Start the bot."""
-    init_db()
+async def post_stop(application: Application):
+    stop_scheduler(application)
+    await application.bot_data["delivery"].stop()
+
+
+async def post_shutdown(application: Application):
+    if "metrics_server" in application.bot_data:
+        application.bot_data["metrics_server"].close()
+    await flush_pending_writes()
+    if SCHEDULER_MODE == "leased":
+        # Claimed jobs that did not fire yet go to the other workers now
+        # rather than when their leases lapse.
+        await release_leases()
+    await close_db()
 
-    application = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
-    load_jobs_from_db(application, reminder_callback)
+
+def build_request(get_updates: bool = False) -> HTTPXRequest:
+    """The HTTP client for Bot API calls, or for getUpdates alone.
+
+    getUpdates holds its connection for the whole long poll, so it gets one
+    to itself instead of tying up one of the shared pool.
+    """
+    pool_size = 1 if get_updates else HTTP_POOL_SIZE
+    return HTTPXRequest(
+        connection_pool_size=pool_size,
+        connect_timeout=HTTP_CONNECT_TIMEOUT,
+        read_timeout=HTTP_READ_TIMEOUT,
+        write_timeout=HTTP_WRITE_TIMEOUT,
+        media_write_timeout=HTTP_MEDIA_TIMEOUT,
+        pool_timeout=HTTP_POOL_TIMEOUT,
+        http_version=HTTP_VERSION,
+        httpx_kwargs={
+            "limits": httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size,
+                keepalive_expiry=HTTP_KEEPALIVE,
+            )
+        },
+    )
+
+
+def build_application(token: str = BOT_TOKEN, base_url: Optional[str] = None):
+    """Build the Application with all handlers registered.
+
+    `base_url` points the bot at another Bot API server, e.g. the fake one
+    used by the benchmarks.
+    """
+    builder = (
+        Application.builder()
+        .token(token)
+        .request(build_request())
+        .get_updates_request(build_request(get_updates=True))
+        .concurrent_updates(
+            ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_MAX_PENDING)
+        )
+        # Bounded, so a backed-up processor stops the updater from fetching.
+        .update_queue(asyncio.Queue(UPDATE_MAX_PENDING))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("set", set_msg))
     application.add_handler(CommandHandler("remind", remind))
     application.add_handler(CommandHandler("help", help))
     application.add_handler(CommandHandler("all", view_reminders))
+    application.add_handler(CallbackQueryHandler(view_reminders_page, pattern=r"^all:"))
     application.add_handler(CommandHandler("cancel", cancel_job))
+    application.add_handler(CommandHandler("coalesce", coalesce))
+    application.add_handler(CommandHandler("timezone", set_timezone))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("deliveries", deliveries))
+    application.add_handler(CommandHandler("profile", profiling))
+    application.add_handler(CommandHandler("export", export_reminders))
+    # /import comes as the caption of the uploaded file, or as a reply to it.
+    application.add_handler(CommandHandler("import", import_reminders))
+    application.add_handler(
+        MessageHandler(
+            filters.Document.ALL & filters.CaptionRegex(r"^/import(@\w+)?(\s|$)"),
+            import_reminders,
+        )
+    )
+    application.add_handler(
+        ChatMemberHandler(track_chat_members, ChatMemberHandler.ANY_CHAT_MEMBER)
+    )
     # application.add_handler(MessageHandler(filters.COMMAND, unknown))
+    application.add_error_handler(error_handler)
+    return application
 
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+def main():
+    """Start the bot."""
+    setup_logging()
+    application = build_application()
+    try:
+        if WEBHOOK_URL:
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=ALLOWED_UPDATES,
+            )
+        else:
+            application.run_polling(allowed_updates=ALLOWED_UPDATES)
+    finally:
+        stop_logging()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,193 @@
+import asyncio
+import bisect
+import logging
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+LabelValues = Tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_registry: List["_Metric"] = []
+
+
+def _format_labels(names: Sequence[str], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        _registry.append(self)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for labels, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Gauge(_Metric):
+    """A value read from `collect` at scrape time, e.g. a queue length."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.collect: Optional[Callable[[], float]] = None
+
+    @property
+    def value(self) -> Optional[float]:
+        return self.collect() if self.collect else None
+
+    def render(self) -> List[str]:
+        value = self.value
+        return super().render() + (
+            [f"{self.name} {value}"] if value is not None else []
+        )
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # labels -> (per-bucket counts with a final +Inf bucket, sum, count)
+        self.series: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def count(self, *labels: str) -> int:
+        series = self.series.get(labels)
+        return series[2] if series else 0
+
+    def mean(self, *labels: str) -> float:
+        series = self.series.get(labels)
+        return series[1] / series[2] if series else 0.0
+
+    def quantile(self, q: float, *labels: str) -> float:
+        """Upper bound of the bucket holding the q-quantile (inf past the last)."""
+        series = self.series.get(labels)
+        if not series:
+            return 0.0
+        rank = q * series[2]
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), series[0]):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for labels, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                le = _format_labels(self.labels, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            label_text = _format_labels(self.labels, labels)
+            lines.append(f"{self.name}_sum{label_text} {total}")
+            lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+
+handler_latency = Histogram(
+    "bot_handler_latency_seconds", "Time spent in update handlers.", ["handler"]
+)
+scheduler_lag = Histogram(
+    "bot_reminder_lag_seconds",
+    "Delay between a reminder's scheduled run time and its callback firing.",
+)
+delivery_lag = Histogram(
+    "bot_delivery_lag_seconds",
+    "Delay between a reminder's scheduled run time and Telegram accepting it.",
+)
+db_query_latency = Histogram(
+    "bot_db_query_seconds", "Time spent running storage calls.", ["query"]
+)
+api_errors = Counter(
+    "bot_api_errors_total", "Errors raised by Bot API calls.", ["error"]
+)
+job_queue_size = Gauge(
+    "bot_job_queue_size", "Jobs registered with the job queue or timing wheel."
+)
+delivery_queue_size = Gauge(
+    "bot_delivery_queue_size", "Messages waiting in the delivery queue."
+)
+update_queue_size = Gauge(
+    "bot_update_queue_size", "Updates received and not yet handled."
+)
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def _serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.split()
+        if len(parts) > 1 and parts[1] == b"/metrics":
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host: str, port: int) -> asyncio.AbstractServer:
+    """Serve GET /metrics on host:port."""
+    server = await asyncio.start_server(_serve, host, port)
+    logger.info("Serving metrics on http://%s:%s/metrics", host, port)
+    return server
@@ -0,0 +1,230 @@
+"""Recurrence rules of repeating reminders: when each one runs next.
+
+A rule is kept as text in the interval column of the jobs table:
+
+- hourly, daily or weekly, the original intervals;
+- <N>m, <N>h, <N>d or <N>w: every N minutes, hours, days or weeks, e.g. 90m;
+- cron <minute> <hour> <day> <month> <weekday> [@<time zone>]: a crontab
+  schedule in the wall-clock time of an IANA time zone, UTC if none is given,
+  e.g. "cron 0 9 * * mon-fri @Europe/Berlin".
+
+compile_rule() parses a rule once and caches it. A fixed interval finds its
+next run in closed form from the run it replaces, so a late fire does not
+push the later ones back; a cron rule binary-searches each field in turn
+instead of stepping through the calendar minute by minute.
+"""
+
+import bisect
+import calendar
+import re
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Dict, Optional, Sequence, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from utils.helpers import to_epoch_ms
+
+NAMED = {"hourly": 3_600_000, "daily": 86_400_000, "weekly": 604_800_000}
+UNITS = {"m": 60_000, "h": 3_600_000, "d": 86_400_000, "w": 604_800_000}
+UNIT_ALIASES = {"min": "m", "hr": "h"}
+UNIT_NAMES = {"m": "minute", "h": "hour", "d": "day", "w": "week"}
+
+_EVERY = re.compile(r"(\d+)(m|min|h|hr|d|w)")
+# Per cron field: lowest and highest value, and names allowed for values.
+_MONTHS = {
+    name.lower(): number for number, name in enumerate(calendar.month_abbr) if name
+}
+_WEEKDAYS = {"sun": 0, "mon": 1, "tue": 2, "wed": 3, "thu": 4, "fri": 5, "sat": 6}
+_FIELDS = (
+    ("minute", 0, 59, {}),
+    ("hour", 0, 23, {}),
+    ("day", 1, 31, {}),
+    ("month", 1, 12, _MONTHS),
+    ("weekday", 0, 7, _WEEKDAYS),
+)
+# Feb 29 on a given weekday can be this many years away.
+_SEARCH_YEARS = 28
+
+
+def parse_zone(name: str) -> ZoneInfo:
+    """The time zone called `name`, e.g. Europe/Berlin; ValueError if unknown."""
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"unknown time zone {name!r}") from None
+
+
+class Rule:
+    """A compiled rule. `text` is its canonical form, as stored in the DB."""
+
+    text = ""
+    # Milliseconds between runs, for rules with a fixed interval.
+    period_ms: Optional[int] = None
+
+    def next_after(self, scheduled: int, now: int) -> int:
+        """The first run after epoch ms `now`, following the run at `scheduled`."""
+        raise NotImplementedError
+
+    def describe(self) -> str:
+        raise NotImplementedError
+
+
+class Every(Rule):
+    def __init__(self, text: str, period_ms: int):
+        self.text = text
+        self.period_ms = period_ms
+
+    def next_after(self, scheduled: int, now: int) -> int:
+        # Runs missed in between are skipped, keeping to the original slots.
+        return scheduled + max((now - scheduled) // self.period_ms + 1, 1) * (
+            self.period_ms
+        )
+
+    def describe(self) -> str:
+        if self.text in NAMED:
+            return self.text
+        count, unit = int(self.text[:-1]), UNIT_NAMES[self.text[-1]]
+        return f"every {unit}" if count == 1 else f"every {count} {unit}s"
+
+
+class Cron(Rule):
+    def __init__(self, fields: Sequence[str], zone: Optional[str]):
+        if len(fields) != len(_FIELDS):
+            raise ValueError("cron takes five fields: minute hour day month weekday")
+        values = [_parse_field(field, *spec) for field, spec in zip(fields, _FIELDS)]
+        self.minutes, self.hours, self.days, self.months, weekdays = values
+        # 7 is Sunday as well as 0.
+        self.weekdays = tuple(sorted({day % 7 for day in weekdays}))
+        # As in cron, a restricted day and weekday match either one; an
+        # unrestricted one (starting with *) is left out.
+        self.any_day = fields[2].startswith("*")
+        self.any_weekday = fields[4].startswith("*")
+        self.zone = parse_zone(zone) if zone else ZoneInfo("UTC")
+        self.text = "cron " + " ".join(fields) + (f" @{zone}" if zone else "")
+        if self._next_local(datetime(2000, 1, 1)) is None:
+            raise ValueError(f"{' '.join(fields)} never runs")
+
+    def describe(self) -> str:
+        return f"on cron schedule {self.text[5:]}"
+
+    def next_after(self, scheduled: int, now: int) -> int:
+        after = max(scheduled, now)
+        local = datetime.fromtimestamp(after / 1000, self.zone).replace(
+            tzinfo=None, second=0, microsecond=0
+        ) + timedelta(minutes=1)
+        while True:
+            found = self._next_local(local)
+            if found is None:
+                raise ValueError(f"{self.text} has no run left")
+            # The wall-clock time repeated when clocks go back can map to
+            # before `after`; the next match is then the one to take.
+            moment = to_epoch_ms(found.replace(tzinfo=self.zone))
+            if moment > after:
+                return moment
+            local = found + timedelta(minutes=1)
+
+    def _day(self, year: int, month: int, day: int) -> Optional[int]:
+        """The first matching day of the month from `day` on, if any."""
+        last = calendar.monthrange(year, month)[1]
+        best = None
+        if not self.any_day or self.any_weekday:
+            i = bisect.bisect_left(self.days, day)
+            if i < len(self.days) and self.days[i] <= last:
+                best = self.days[i]
+        if not self.any_weekday:
+            weekday = (calendar.weekday(year, month, day) + 1) % 7
+            i = bisect.bisect_left(self.weekdays, weekday)
+            if i < len(self.weekdays):
+                ahead = self.weekdays[i] - weekday
+            else:
+                ahead = self.weekdays[0] + 7 - weekday
+            if day + ahead <= last and (best is None or day + ahead < best):
+                best = day + ahead
+        return best
+
+    def _next_local(self, t: datetime) -> Optional[datetime]:
+        """The first matching wall-clock minute at or after naive `t`."""
+        limit = t.year + _SEARCH_YEARS
+        while t.year <= limit:
+            i = bisect.bisect_left(self.months, t.month)
+            if i == len(self.months):
+                t = datetime(t.year + 1, self.months[0], 1)
+                continue
+            if self.months[i] != t.month:
+                t = datetime(t.year, self.months[i], 1)
+                continue
+            day = self._day(t.year, t.month, t.day)
+            if day is None:
+                t = datetime(t.year + t.month // 12, t.month % 12 + 1, 1)
+                continue
+            if day != t.day:
+                t = datetime(t.year, t.month, day)
+                continue
+            i = bisect.bisect_left(self.hours, t.hour)
+            if i == len(self.hours):
+                t = datetime(t.year, t.month, t.day) + timedelta(days=1)
+                continue
+            if self.hours[i] != t.hour:
+                t = t.replace(hour=self.hours[i], minute=0)
+                continue
+            i = bisect.bisect_left(self.minutes, t.minute)
+            if i == len(self.minutes):
+                t = t.replace(minute=0) + timedelta(hours=1)
+                continue
+            return t.replace(minute=self.minutes[i])
+        return None
+
+
+def _parse_field(
+    text: str, name: str, low: int, high: int, names: Dict[str, int]
+) -> Tuple[int, ...]:
+    def value(part: str) -> int:
+        number = names.get(part)
+        if number is None:
+            if not part.isdigit():
+                raise ValueError(f"bad {name} {part!r}")
+            number = int(part)
+        return number
+
+    values = set()
+    for part in text.split(","):
+        span, slash, step_text = part.partition("/")
+        if slash and not step_text.isdigit():
+            raise ValueError(f"bad {name} step {part!r}")
+        step = int(step_text) if slash else 1
+        if span == "*":
+            start, end = low, high
+        else:
+            first, dash, last = span.partition("-")
+            start = value(first)
+            end = value(last) if dash else (high if slash else start)
+        if step < 1 or not low <= start <= end <= high:
+            raise ValueError(f"bad {name} {part!r}")
+        values.update(range(start, end + 1, step))
+    return tuple(sorted(values))
+
+
+@lru_cache(maxsize=4096)
+def compile_rule(text: str, zone: Optional[str] = None) -> Rule:
+    """Parse a rule, e.g. "daily", "90m" or "cron 0 9 * * 1-5"; cached.
+
+    `zone` is the time zone for a cron rule that does not name one. Raises
+    ValueError for anything else.
+    """
+    words = text.split()
+    head = words[0].lower() if words else ""
+    if head == "cron":
+        fields = [word.lower() for word in words[1:]]
+        if fields and fields[-1].startswith("@"):
+            zone = words[-1][1:]
+            fields.pop()
+        return Cron(fields, zone)
+    if len(words) == 1:
+        if head in NAMED:
+            return Every(head, NAMED[head])
+        match = _EVERY.fullmatch(head)
+        if match and int(match[1]) > 0:
+            unit = UNIT_ALIASES.get(match[2], match[2])
+            count = int(match[1])
+            return Every(f"{count}{unit}", count * UNITS[unit])
+    raise ValueError(f"unknown interval {text!r}")
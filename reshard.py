@@ -0,0 +1,165 @@
+"""Move the reminders database to another number of shards (DB_SHARDS).
+
+    python reshard.py 4           # jobs.db -> jobs-0-of-4.db ... jobs-3-of-4.db
+    python reshard.py 1 --from 4  # and back to a single jobs.db
+
+Run it with the bot and any workers stopped, then start them again with
+DB_SHARDS set to the new count. The files of the current layout (DB_SHARDS,
+or --from) are read and every job, chat setting and delivery log row is
+written to the new file of its chat, each new file in one transaction. Job
+numbers (seq, the IDs /all shows) are kept unless two old shards used the
+same one for chats that now share a file, and no new file hands out a number
+an old one already used; leases are dropped. Only once all of that is
+committed are the old files renamed to *.old, so an interrupted run leaves the
+old layout as it was.
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+from collections import Counter
+from typing import Dict, List, Optional
+
+import db
+from settings import DB_SHARDS
+
+# A job keeps its seq unless the target file already has it.
+_INSERT_JOB = """
+    INSERT INTO jobs (seq, id, chat_id, user_id, message, interval, next_run_time)
+    VALUES (
+        CASE WHEN EXISTS (SELECT 1 FROM jobs WHERE seq = :seq)
+        THEN NULL ELSE :seq END,
+        :id, :chat_id, :user_id, :message, :interval, :next_run_time
+    )
+"""
+_SELECT_JOBS = (
+    "SELECT seq, id, chat_id, user_id, message, interval, next_run_time"
+    " FROM jobs ORDER BY seq"
+)
+_SELECT_LAST_SEQ = "SELECT seq FROM sqlite_sequence WHERE name = 'jobs'"
+_UPDATE_LAST_SEQ = "UPDATE sqlite_sequence SET seq = max(seq, ?) WHERE name = 'jobs'"
+_INSERT_LAST_SEQ = "INSERT INTO sqlite_sequence (name, seq) VALUES ('jobs', ?)"
+_INSERT_CHAT_SETTINGS = "INSERT INTO chat_settings VALUES (?, ?, ?)"
+_SELECT_CHAT_SETTINGS = "SELECT chat_id, coalesce_window, timezone FROM chat_settings"
+_SELECT_DELIVERIES = "SELECT job_id, chat_id, scheduled, sent, outcome FROM {table}"
+
+
+def _files(path: str) -> List[str]:
+    return [
+        path + suffix
+        for suffix in ("", "-wal", "-shm")
+        if os.path.exists(path + suffix)
+    ]
+
+
+def reshard(sources: List[str], targets: List[str]) -> Counter:
+    """Copy the rows of the `sources` files into `targets`, routed by chat.
+
+    Sources are brought up to the current schema first. On error the targets
+    are removed again. Returns how many jobs, chat settings and deliveries
+    were copied.
+    """
+    copied: Counter = Counter()
+    outputs = [db._open(path) for path in targets]
+    try:
+        for conn in outputs:
+            db._prepare(conn)
+            conn.execute("BEGIN")
+        tables: List[set] = [set() for _ in outputs]
+        last_seq = 0
+        for path in sources:
+            source = db._open(path)
+            try:
+                db._prepare(source)
+                row = source.execute(_SELECT_LAST_SEQ).fetchone()
+                last_seq = max(last_seq, row["seq"] if row else 0)
+                for row in source.execute(_SELECT_JOBS):
+                    target = outputs[db.shard_for(row["chat_id"], len(outputs))]
+                    target.execute(_INSERT_JOB, dict(row))
+                    copied["jobs"] += 1
+                for row in source.execute(_SELECT_CHAT_SETTINGS):
+                    target = outputs[db.shard_for(row["chat_id"], len(outputs))]
+                    target.execute(_INSERT_CHAT_SETTINGS, tuple(row))
+                    copied["chat settings"] += 1
+                for (table,) in source.execute(db._SELECT_DELIVERY_TABLES).fetchall():
+                    for row in source.execute(_SELECT_DELIVERIES.format(table=table)):
+                        index = db.shard_for(row["chat_id"], len(outputs))
+                        if table not in tables[index]:
+                            outputs[index].execute(
+                                db._CREATE_DELIVERIES.format(table=table)
+                            )
+                            outputs[index].execute(
+                                db._CREATE_DELIVERIES_INDEX.format(table=table)
+                            )
+                            tables[index].add(table)
+                        outputs[index].execute(
+                            db._INSERT_DELIVERY.format(table=table), tuple(row)
+                        )
+                        copied["deliveries"] += 1
+            finally:
+                source.close()
+        # Numbers freed by jobs deleted before the move stay retired.
+        for conn in outputs:
+            if not conn.execute(_UPDATE_LAST_SEQ, (last_seq,)).rowcount:
+                conn.execute(_INSERT_LAST_SEQ, (last_seq,))
+            conn.commit()
+    except BaseException:
+        for conn in outputs:
+            conn.close()
+        for path in targets:
+            for name in _files(path):
+                os.remove(name)
+        raise
+    for conn in outputs:
+        conn.close()
+    return copied
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("shards", type=int, help="number of shards to move to")
+    parser.add_argument(
+        "--from",
+        dest="current",
+        type=int,
+        default=DB_SHARDS,
+        help="number of shards now (default: DB_SHARDS)",
+    )
+    args = parser.parse_args(argv)
+    if args.shards < 1 or args.current < 1:
+        parser.error("shard counts must be at least 1")
+    if args.shards == args.current:
+        parser.error(f"the database already has {args.current} shard(s)")
+
+    sources = [db.shard_path(index, args.current) for index in range(args.current)]
+    targets = [db.shard_path(index, args.shards) for index in range(args.shards)]
+    missing = [path for path in sources if not os.path.exists(path)]
+    if missing:
+        print(f"Not found: {', '.join(missing)}", file=sys.stderr)
+        return 1
+    existing = [path for path in targets if _files(path)]
+    if existing:
+        print(f"Already exist: {', '.join(existing)}", file=sys.stderr)
+        return 1
+
+    try:
+        copied = reshard(sources, targets)
+    except sqlite3.Error as e:
+        print(f"Resharding failed, nothing was changed: {e}", file=sys.stderr)
+        return 1
+    for path in sources:
+        for name in _files(path):
+            os.replace(name, name.replace(path, path + ".old", 1))
+    counts: Dict[str, int] = {"jobs": 0, "chat settings": 0, "deliveries": 0}
+    counts.update(copied)
+    print(
+        f"Moved {', '.join(f'{count} {name}' for name, count in counts.items())}"
+        f" from {args.current} to {args.shards} shard(s); set DB_SHARDS={args.shards}",
+        file=sys.stderr,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+"""Where reminders wait until they are due: PTB's job queue or a timing wheel.
+
+SCHEDULER_BACKEND=jobqueue registers every reminder as an APScheduler job.
+SCHEDULER_BACKEND=wheel keeps just the job id and due time in a TimingWheel,
+which scales to millions of pending reminders. Either way a repeating reminder
+is registered one run at a time, and fire_reminder reads the message and
+the rest from the DB when the reminder fires.
+"""
+
+from datetime import datetime, timedelta
+from typing import Callable, List, Union
+
+from telegram.ext import Application, Job
+from telegram.ext._utils.types import JobCallback
+
+import clock
+from settings import SCHEDULER_BACKEND, WHEEL_TICK
+from timing_wheel import TimingWheel
+from utils.helpers import to_epoch_ms
+
+
+def start_scheduler(application: Application, fire: Callable[[List[str]], None]):
+    """Set up the wheel, if used; `fire` gets the ids of due reminders."""
+    if SCHEDULER_BACKEND == "wheel":
+        wheel = TimingWheel(fire, tick=WHEEL_TICK)
+        wheel.start()
+        application.bot_data["wheel"] = wheel
+
+
+def stop_scheduler(application: Application):
+    if "wheel" in application.bot_data:
+        application.bot_data["wheel"].stop()
+
+
+def scheduled_count(application: Application) -> int:
+    count = len(application.job_queue.scheduler.get_jobs())
+    if "wheel" in application.bot_data:
+        count += len(application.bot_data["wheel"])
+    return count
+
+
+def schedule_reminder(
+    application: Application,
+    reminder_callback: JobCallback,
+    job_id: str,
+    chat_id: int,
+    user_id: int,
+    when: Union[float, datetime],
+):
+    """Register a reminder to fire at `when` (a datetime, or seconds from now).
+
+    Only one run is registered at a time; fire_reminder registers the next
+    run of a repeating reminder. Registering a job id that is already
+    registered is a no-op, since a handler may have registered the job while
+    its window was being read.
+    """
+    if SCHEDULER_BACKEND == "wheel":
+        wheel = application.bot_data["wheel"]
+        if job_id in wheel:
+            return
+        if not isinstance(when, datetime):
+            when = clock.now() + timedelta(seconds=when)
+        wheel.add(job_id, to_epoch_ms(when))
+        return
+
+    if application.job_queue.scheduler.get_job(job_id):
+        return
+    application.job_queue.run_once(
+        reminder_callback,
+        when,
+        chat_id=chat_id,
+        user_id=user_id,
+        name=str(chat_id),
+        job_kwargs={"id": job_id},
+    )
+
+
+def unschedule_reminder(application: Application, job_id: str) -> bool:
+    """Drop a registered reminder. Returns whether it was registered."""
+    if SCHEDULER_BACKEND == "wheel":
+        return application.bot_data["wheel"].remove(job_id)
+    aps_job = application.job_queue.scheduler.get_job(job_id)
+    if aps_job:
+        Job.from_aps_job(aps_job).schedule_removal()
+    return aps_job is not None
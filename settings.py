@@ -1,10 +1,147 @@
 import os
+import socket
 import sys
+from urllib.parse import urlparse
 
 LIST_OF_USERS = list(map(int, os.getenv("LIST_OF_USERS", "").split(",")))
 GROUP_ID = int(os.getenv("GROUP_ID", ""))
 PERSONAL_USER_ID = int(os.getenv("PERSONAL_USER_ID", ""))
+# Reminder bookkeeping is written behind: flushed every WRITE_BEHIND_INTERVAL
+# seconds, or as soon as WRITE_BEHIND_MAX_PENDING writes are queued.
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", "1"))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "500"))
+# Chat administrator lists are cached for this many seconds; membership
+# updates invalidate them earlier.
+ADMIN_CACHE_TTL = float(os.getenv("ADMIN_CACHE_TTL", "300"))
+# User profiles shown by /all, cached per (chat, user).
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "3600"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_LOOKUP_CONCURRENCY = int(os.getenv("USER_LOOKUP_CONCURRENCY", "8"))
+REMINDERS_PAGE_SIZE = int(os.getenv("REMINDERS_PAGE_SIZE", "20"))
+# Updates from different chats are handled concurrently, up to
+# UPDATE_CONCURRENCY at once; each chat's run in order. Past UPDATE_MAX_PENDING
+# queued updates the bot stops taking new ones until some finish.
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "16"))
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "256"))
+# Only jobs due within LOAD_HORIZON seconds are kept in the job queue; the
+# window is topped up from the DB every LOAD_REFILL_INTERVAL seconds.
+LOAD_HORIZON = float(os.getenv("LOAD_HORIZON", str(6 * 60 * 60)))
+LOAD_REFILL_INTERVAL = float(os.getenv("LOAD_REFILL_INTERVAL", str(10 * 60)))
+# One-shot reminders missed while the bot was down are dropped at startup, or
+# with "late" sent anyway, LATE_DELIVERY_RATE per second.
+MISSED_ONESHOT_POLICY = os.getenv("MISSED_ONESHOT_POLICY", "drop")
+LATE_DELIVERY_RATE = float(os.getenv("LATE_DELIVERY_RATE", "5"))
+# "local" keeps the due jobs of the whole DB in this process's job queue, so
+# only one process may run. "leased" lets any number of processes (main.py
+# plus worker.py replicas) share the DB: each claims the jobs due within the
+# next CLAIM_INTERVAL seconds, up to CLAIM_BATCH at a time, under a lease that
+# lapses LEASE_DURATION seconds after the job was due, so jobs of a crashed
+# worker are picked up by the others.
+SCHEDULER_MODE = os.getenv("SCHEDULER_MODE", "local")
+WORKER_ID = os.getenv("WORKER_ID", f"{socket.gethostname()}-{os.getpid()}")
+CLAIM_INTERVAL = float(os.getenv("CLAIM_INTERVAL", "1"))
+CLAIM_BATCH = int(os.getenv("CLAIM_BATCH", "500"))
+LEASE_DURATION = float(os.getenv("LEASE_DURATION", "30"))
+# "jobqueue" registers each loaded reminder as an APScheduler job; "wheel"
+# keeps just ids and due times in a timing wheel ticking every WHEEL_TICK
+# seconds, for very large numbers of pending reminders.
+SCHEDULER_BACKEND = os.getenv("SCHEDULER_BACKEND", "jobqueue")
+WHEEL_TICK = float(os.getenv("WHEEL_TICK", "0.1"))
+# Reminders firing within FIRE_BATCH_WINDOW seconds of each other are read
+# from the DB with one query.
+FIRE_BATCH_WINDOW = float(os.getenv("FIRE_BATCH_WINDOW", "0.01"))
+# Jobs, chat settings and delivery history are split by chat over DB_SHARDS
+# SQLite files, each written by a thread of its own, so busy chats do not all
+# queue for one write lock. Change it only together with reshard.py.
+DB_SHARDS = int(os.getenv("DB_SHARDS", "1"))
+# Outbound rate limits: messages per second overall, per minute to a group and
+# per second to a private chat, as documented for the Bot API.
+DELIVERY_GLOBAL_RATE = float(os.getenv("DELIVERY_GLOBAL_RATE", "30"))
+DELIVERY_GROUP_RATE = float(os.getenv("DELIVERY_GROUP_RATE", "20"))
+DELIVERY_PRIVATE_RATE = float(os.getenv("DELIVERY_PRIVATE_RATE", "1"))
+DELIVERY_CONCURRENCY = int(os.getenv("DELIVERY_CONCURRENCY", "16"))
+DELIVERY_MAX_RETRIES = int(os.getenv("DELIVERY_MAX_RETRIES", "5"))
+# Days of delivery history kept for /deliveries; 0 turns the log off.
+DELIVERY_LOG_DAYS = int(os.getenv("DELIVERY_LOG_DAYS", "7"))
+# Bot API HTTP client. Every call but getUpdates shares one pool of
+# HTTP_POOL_SIZE connections, sized for the senders and update handlers that
+# run at once and kept alive for HTTP_KEEPALIVE seconds between calls.
+# HTTP_VERSION=2 needs the httpx[http2] extra. Uploads and file downloads get
+# HTTP_MEDIA_TIMEOUT instead of the read and write timeouts.
+HTTP_VERSION = os.getenv("HTTP_VERSION", "1.1")
+HTTP_POOL_SIZE = int(
+    os.getenv("HTTP_POOL_SIZE", str(DELIVERY_CONCURRENCY + 2 * UPDATE_CONCURRENCY))
+)
+HTTP_POOL_TIMEOUT = float(os.getenv("HTTP_POOL_TIMEOUT", "5"))
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", "60"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "5"))
+HTTP_WRITE_TIMEOUT = float(os.getenv("HTTP_WRITE_TIMEOUT", "5"))
+HTTP_MEDIA_TIMEOUT = float(os.getenv("HTTP_MEDIA_TIMEOUT", "30"))
+# Default window, in seconds, for chats that turn on /coalesce.
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "2"))
+# Handlers and reminder_callback run under cProfile while profiling is on
+# (PROFILE_ENABLED=1 at startup, or /profile on). Calls slower than
+# PROFILE_THRESHOLD seconds, and a PROFILE_SAMPLE_RATE fraction of the others,
+# are saved to PROFILE_DIR, which keeps the latest PROFILE_KEEP profiles.
+PROFILE_ENABLED = os.getenv("PROFILE_ENABLED", "").lower() in ("1", "true", "yes")
+PROFILE_THRESHOLD = float(os.getenv("PROFILE_THRESHOLD", "0.5"))
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv(
+    "PROFILE_DIR", os.path.join(os.getenv("VOLUME_MOUNT_PATH", "."), "profiles")
+)
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "20"))
+# Logs go to stderr as text or, with LOG_FORMAT=json, one JSON object per
+# line. LOG_RATE_LIMITS caps chatty loggers (and their children) at a number
+# of records below WARNING per second, as "logger=rate,logger=rate".
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_RATE_LIMITS = {
+    name.strip(): float(rate)
+    for name, _, rate in (
+        item.partition("=")
+        for item in os.getenv("LOG_RATE_LIMITS", "apscheduler=1").split(",")
+        if item.strip()
+    )
+}
+# Prometheus metrics are served on METRICS_HOST:METRICS_PORT/metrics when
+# METRICS_PORT is set; /stats shows a summary either way.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# With WEBHOOK_URL set (the public URL Telegram should POST updates to) the
+# bot serves a webhook on WEBHOOK_LISTEN:WEBHOOK_PORT instead of long polling.
+# Requests must carry WEBHOOK_SECRET in the X-Telegram-Bot-Api-Secret-Token
+# header.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", urlparse(WEBHOOK_URL).path.strip("/"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 if not BOT_TOKEN:
     print("You have forgot to set BOT_TOKEN")
     sys.exit()
+if SCHEDULER_MODE not in ("local", "leased"):
+    print("SCHEDULER_MODE must be local or leased")
+    sys.exit()
+if SCHEDULER_BACKEND not in ("jobqueue", "wheel"):
+    print("SCHEDULER_BACKEND must be jobqueue or wheel")
+    sys.exit()
+if MISSED_ONESHOT_POLICY not in ("drop", "late"):
+    print("MISSED_ONESHOT_POLICY must be drop or late")
+    sys.exit()
+if DB_SHARDS < 1:
+    print("DB_SHARDS must be at least 1")
+    sys.exit()
+if HTTP_VERSION not in ("1.1", "2"):
+    print("HTTP_VERSION must be 1.1 or 2")
+    sys.exit()
+if LOG_FORMAT not in ("text", "json"):
+    print("LOG_FORMAT must be text or json")
+    sys.exit()
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    print("You have forgot to set WEBHOOK_SECRET")
+    sys.exit()
+if PROFILE_KEEP < 1:
+    print("PROFILE_KEEP must be at least 1")
+    sys.exit()
@@ -0,0 +1,426 @@
+"""Time-warp simulation: replay weeks or months of reminders in seconds.
+
+Run from the repository root, e.g.
+
+    python simulate.py --days 90 --reminders 10000 --chats 500
+    python simulate.py --db /data/jobs.db --days 30
+
+The real scheduling and bookkeeping code (the timing wheel, load_jobs_from_db
+with its startup recovery, fire_reminder and the write-behind flushes) runs
+on a virtual clock that jumps from one due reminder to the next, against a
+scratch copy of a jobs DB, or a generated one, and a stand-in for the
+delivery queue that records what was sent. The result is printed as JSON:
+fires against the runs each reminder should have had, how late they fired,
+how far repeating reminders drifted off their original time of day, and how
+much the DB was read and written.
+
+Throughput is bound by the DB writes, about 12,000 fires a second on a
+laptop SSD: a virtual day of 100,000 reminders with the default mix (about
+310,000 fires) takes some 25 s, and a year of 100 daily reminders about 30 s,
+spent mostly on the window loads. --exact-flushes, flushing as often as the
+bot does rather than once a step, makes the busy case take over twice as long.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+# The bot reads its configuration at import time. Everything else in the
+# environment (LOAD_HORIZON, MISSED_ONESHOT_POLICY, ...) applies as usual.
+os.environ.update(
+    BOT_TOKEN="1000:simulate",
+    GROUP_ID="-1",
+    PERSONAL_USER_ID="1",
+    LIST_OF_USERS="1",
+    VOLUME_MOUNT_PATH=tempfile.mkdtemp(),
+    SCHEDULER_BACKEND="wheel",
+    SCHEDULER_MODE="local",
+    # Due reminders are fired tick by tick, so there is nothing to wait for.
+    FIRE_BATCH_WINDOW="0",
+)
+
+import clock  # noqa: E402
+import db  # noqa: E402
+from handlers import command_handlers  # noqa: E402
+from handlers.command_handlers import fire_reminder, reminder_callback  # noqa: E402
+from metrics import db_query_latency  # noqa: E402
+from recurrence import compile_rule  # noqa: E402
+from reshard import reshard  # noqa: E402
+from settings import (  # noqa: E402
+    DB_SHARDS,
+    DELIVERY_LOG_DAYS,
+    LOAD_REFILL_INTERVAL,
+    WRITE_BEHIND_INTERVAL,
+)
+from timing_wheel import TimingWheel  # noqa: E402
+
+DEFAULT_MIX = "hourly=1,daily=6,weekly=2,once=1"
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    """Count, mean, p50/p99 and max of samples in seconds."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pct(p):
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))], 3)
+
+    return {
+        "count": len(ordered),
+        "mean_s": round(sum(ordered) / len(ordered), 3),
+        "p50_s": pct(0.50),
+        "p99_s": pct(0.99),
+        "max_s": round(ordered[-1], 3),
+    }
+
+
+class VirtualClock:
+    """Epoch seconds that only move when the simulation moves them."""
+
+    def __init__(self, now: float):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class SimApplication:
+    """The parts of Application that loading and firing reminders use."""
+
+    def __init__(self):
+        self.bot_data: dict = {}
+        self._tasks: List[asyncio.Task] = []
+
+    def create_task(self, coroutine, update=None) -> asyncio.Task:
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.append(task)
+        return task
+
+    async def settle(self):
+        """Wait for the tasks created so far and any they create in turn."""
+        while self._tasks:
+            tasks, self._tasks = self._tasks, []
+            await asyncio.gather(*tasks)
+
+
+class RecordingDelivery:
+    """Stands in for DeliveryQueue: counts the sends and logs them as sent."""
+
+    def __init__(self):
+        self.fired: Counter = Counter()
+        self.late: List[float] = []
+
+    def __len__(self) -> int:
+        return 0
+
+    def enqueue(self, chat_id: int, text: str, due=None, job_id=None):
+        now = clock.time()
+        self.fired[job_id] += 1
+        if due is not None:
+            self.late.append(now - due)
+        if DELIVERY_LOG_DAYS > 0:
+            db.queue_delivery_log(job_id, chat_id, due, now, "sent")
+
+
+class DueRows:
+    """Stands in for get_due_job with rows read ahead, one query per step.
+
+    Nothing is canceled during a run and no reminder fires twice in a step,
+    so a row read at the start of the step is still current when it fires.
+    """
+
+    def __init__(self):
+        self.rows: Dict[str, Optional[dict]] = {}
+
+    async def prefetch(self, job_ids: List[str]):
+        jobs = await db.get_jobs_by_ids(job_ids)
+        self.rows.update((job_id, jobs.get(job_id)) for job_id in job_ids)
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        if job_id in self.rows:
+            return self.rows.pop(job_id)
+        return await db.get_due_job(job_id)
+
+
+def parse_mix(text: str) -> List[Tuple[Optional[str], float]]:
+    mix = []
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name != "once":
+            try:
+                name = compile_rule(name).text
+            except ValueError as e:
+                raise SystemExit(f"Bad interval in --mix: {e}")
+        mix.append((None if name == "once" else name, float(weight or 1)))
+    return mix
+
+
+def generate_jobs(args, start: float, end: float) -> List[tuple]:
+    """Jobs rows spread over the chats, first runs spread over a period."""
+    rng = random.Random(args.seed)
+    intervals, weights = zip(*parse_mix(args.mix))
+    rows = []
+    for n in range(args.reminders):
+        interval = rng.choices(intervals, weights)[0]
+        span = period(interval) if interval else end - start
+        first = int((start + rng.uniform(0, span)) * 1000)
+        if interval and not compile_rule(interval).period_ms:
+            # Cron rules start on their first slot from there.
+            first = compile_rule(interval).next_after(first, first)
+        rows.append(
+            (
+                f"sim-{n}",
+                -(10_000 + rng.randrange(args.chats)),
+                1,
+                f"Simulated reminder {n}",
+                interval,
+                first,
+            )
+        )
+    return rows
+
+
+def copy_db(source: str):
+    """Copy a jobs DB, WAL included, to the scratch files the bot will use."""
+    snapshot = db.DB_PATH + ".source"
+    src = sqlite3.connect(f"file:{source}?mode=ro", uri=True)
+    dst = sqlite3.connect(snapshot)
+    with dst:
+        src.backup(dst)
+    src.close()
+    dst.close()
+    reshard([snapshot], [db.shard_path(index) for index in range(DB_SHARDS)])
+
+
+def period(interval: str) -> float:
+    """Seconds between runs of a fixed rule; a day for cron rules."""
+    return (compile_rule(interval).period_ms or 24 * 60 * 60 * 1000) / 1000
+
+
+def expected_runs(
+    interval: Optional[str], first: float, start: float, end: float
+) -> int:
+    """Runs in [start, end) of a job first due at `first`, missed runs skipped."""
+    if interval is None:
+        return int(start <= first < end)
+    rule = compile_rule(interval)
+    scheduled, start_ms, end_ms = int(first * 1000), start * 1000, end * 1000
+    if rule.period_ms:
+        period_ms = rule.period_ms
+        if scheduled < start_ms:
+            scheduled += -(-(start_ms - scheduled) // period_ms) * period_ms
+        return max(0, int(-(-(end_ms - scheduled) // period_ms)))
+    if scheduled < start_ms:
+        scheduled = rule.next_after(scheduled, int(start_ms) - 1)
+    runs = 0
+    while scheduled < end_ms:
+        runs += 1
+        scheduled = rule.next_after(scheduled, scheduled)
+    return runs
+
+
+def shortest_gap(intervals) -> float:
+    """A lower bound, in seconds, on the time between two runs of any rule."""
+    gaps = [24 * 60 * 60]
+    for interval in filter(None, set(intervals)):
+        rule = compile_rule(interval)
+        if rule.period_ms:
+            gaps.append(rule.period_ms / 1000)
+            continue
+        minutes, hours = rule.minutes, rule.hours
+        if len(minutes) > 1:
+            cycle = zip(minutes, minutes[1:] + (minutes[0] + 60,))
+            gaps.append(60 * min(b - a for a, b in cycle))
+        else:
+            cycle = zip(hours, hours[1:] + (hours[0] + 24,))
+            # An hour less for clocks going forward or back in between.
+            gaps.append(max(60, 60 * 60 * (min(b - a for a, b in cycle) - 1)))
+    return min(gaps)
+
+
+def total_changes() -> int:
+    # Straight on the DB threads, so it does not show up in the statement counts.
+    return sum(
+        executor.submit(lambda: db._connection().total_changes).result()
+        for executor in db._executors
+    )
+
+
+async def all_jobs() -> Dict[str, Tuple[Optional[str], float]]:
+    return await db.export_jobs(
+        lambda rows: {row[0]: (row[4], row[5] / 1000) for row in rows}
+    )
+
+
+async def run(args) -> dict:
+    start = args.start
+    end = start + args.days * 24 * 60 * 60
+    virtual = VirtualClock(start)
+    clock.set_clock(virtual)
+
+    if args.db:
+        copy_db(args.db)
+    await db.init_db()
+    if not args.db:
+        await db.import_jobs(generate_jobs(args, start, end))
+    # What every job should do, from the DB as it was before recovery.
+    jobs = await all_jobs()
+    changes_before = total_changes()
+    db_query_latency.series.clear()
+
+    application = SimApplication()
+    delivery = RecordingDelivery()
+    application.bot_data["delivery"] = delivery
+    # Ticks are collected while the wheel advances and fired afterwards, each
+    # at its own virtual time. Steps are no longer than the shortest gap
+    # between two runs of a rule, so no reminder comes due again within the
+    # step that fired it, and the rows of a step's reminders can all be read
+    # with one query before the first of them fires.
+    due_ticks: List[Tuple[int, List[str]]] = []
+    wheel = TimingWheel(
+        lambda job_ids: due_ticks.append((wheel._tick, job_ids)), args.tick
+    )
+    application.bot_data["wheel"] = wheel
+    due_rows = DueRows()
+    command_handlers.get_due_job = due_rows.get
+    step = min(
+        LOAD_REFILL_INTERVAL, shortest_gap(interval for interval, _ in jobs.values())
+    )
+
+    wall_start = time.perf_counter()
+    last_flush = last_prune = start
+    now = start
+    while now < end:
+        virtual.now = now
+        await db.load_jobs_from_db(application, reminder_callback)
+        now = min(now + step, end)
+        wheel.advance(int(now * 1000) // wheel.tick_ms)
+        if due_ticks:
+            await due_rows.prefetch(
+                [job_id for _, job_ids in due_ticks for job_id in job_ids]
+            )
+        for tick, job_ids in due_ticks:
+            virtual.now = tick * wheel.tick_ms / 1000
+            # Otherwise the writes go out with the next window load, once a
+            # step, or when WRITE_BEHIND_MAX_PENDING of them queue up.
+            if args.exact_flushes and virtual.now - last_flush >= WRITE_BEHIND_INTERVAL:
+                await db.flush_pending_writes()
+                last_flush = virtual.now
+            # The rows are read already, so firing one by one, as
+            # fire_reminders' tasks would, skips a loop round trip per tick.
+            for job_id in job_ids:
+                await fire_reminder(application, job_id)
+            await application.settle()
+        due_ticks.clear()
+        virtual.now = now
+        if DELIVERY_LOG_DAYS > 0 and now - last_prune >= 24 * 60 * 60:
+            await db.prune_delivery_log()
+            last_prune = now
+    await db.flush_pending_writes()
+    wall = time.perf_counter() - wall_start
+
+    # Runs and drift per interval. Drift is how far a repeating reminder's
+    # next run has moved off the slots of its fixed interval; cron rules
+    # have no fixed slots, so only their runs are counted.
+    fires: Dict[str, Counter] = defaultdict(Counter)
+    drift: Dict[str, List[float]] = defaultdict(list)
+    statements = {
+        labels[0]: db_query_latency.count(*labels)
+        for labels in sorted(db_query_latency.series)
+    }
+    final = await all_jobs()
+    for job_id, (interval, first) in jobs.items():
+        name = interval or "once"
+        fires[name]["jobs"] += 1
+        fires[name]["expected"] += expected_runs(interval, first, start, end)
+        fires[name]["fired"] += delivery.fired[job_id]
+        if interval and compile_rule(interval).period_ms and job_id in final:
+            drift[name].append((final[job_id][1] - first) % period(interval))
+    size = sum(
+        os.path.getsize(path + suffix)
+        for path in map(db.shard_path, range(DB_SHARDS))
+        for suffix in ("", "-wal")
+        if os.path.exists(path + suffix)
+    )
+    changes = total_changes() - changes_before
+    await db.close_db()
+
+    return {
+        "config": vars(args),
+        "virtual_days": args.days,
+        "wall_seconds": round(wall, 3),
+        "speedup": round((end - start) / wall) if wall else None,
+        "fires": {name: dict(counts) for name, counts in sorted(fires.items())},
+        "late": summarize(delivery.late),
+        "drift": {name: summarize(samples) for name, samples in sorted(drift.items())},
+        "db": {
+            "statements": statements,
+            "rows_changed": changes,
+            "rows_changed_per_day": round(changes / args.days, 1),
+            "size_bytes": size,
+        },
+    }
+
+
+def parse_start(value: str) -> float:
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", help="jobs DB to replay; it is copied, not changed")
+    parser.add_argument("--days", type=float, default=30, help="virtual days to run")
+    parser.add_argument(
+        "--start",
+        type=parse_start,
+        default=float(int(time.time())),
+        help="virtual start time, ISO 8601 (default: now)",
+    )
+    parser.add_argument("--tick", type=float, default=1, help="wheel tick, s")
+    parser.add_argument("--reminders", type=int, default=1000, help="to generate")
+    parser.add_argument("--chats", type=int, default=100, help="to generate")
+    parser.add_argument(
+        "--mix", default=DEFAULT_MIX, help="interval weights of generated reminders"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--exact-flushes",
+        action="store_true",
+        help="flush writes every WRITE_BEHIND_INTERVAL as the bot does (slower)",
+    )
+    parser.add_argument("--out", help="also append the JSON result to this file")
+    args = parser.parse_args()
+    if args.days <= 0:
+        parser.error("--days must be positive")
+
+    from utils.logs import setup_logging, stop_logging
+
+    setup_logging()
+    try:
+        result = asyncio.run(run(args))
+    finally:
+        stop_logging()
+    output = json.dumps(result)
+    print(output)
+    if args.out:
+        with open(args.out, "a") as f:
+            f.write(output + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+
+import clock
+
+logger = logging.getLogger(__name__)
+
+
+class TimingWheel:
+    """Hierarchical timing wheel of job ids and due times, in epoch ms.
+
+    Level 0 has one slot per tick; each slot of level n spans a whole turn of
+    level n - 1. An entry sits in the lowest level whose turn reaches its due
+    tick and moves down a level each time the level below wraps around, so
+    adding and removing are O(1) and a tick only looks at the entries due in
+    it. Entries beyond the top level wait in an overflow slot. `fire` is
+    called with the ids due in each tick, in the event loop.
+
+    `bits` sets the slots per level (2**bits). With the defaults, 0.1 s ticks
+    and 256, 4096 and 4096 slots, the wheel covers 13 years and level 1 alone
+    29 hours, more than a LOAD_HORIZON: moving entries down from level 1
+    takes a slot of 25 s worth of reminders at a time, short enough not to
+    stall the event loop with a million of them pending.
+    """
+
+    def __init__(
+        self,
+        fire: Callable[[List[str]], None],
+        tick: float = 0.1,
+        bits: Sequence[int] = (8, 12, 12),
+    ):
+        self.fire = fire
+        self.tick_ms = max(int(tick * 1000), 1)
+        # Per level: how far ticks are shifted to index it, and its mask.
+        self._shifts = [sum(bits[:level]) for level in range(len(bits))]
+        self._masks = [(1 << level_bits) - 1 for level_bits in bits]
+        self._spans = [1 << (sum(bits[: level + 1])) for level in range(len(bits))]
+        self._levels: List[List[Dict[str, int]]] = [
+            [{} for _ in range(1 << level_bits)] for level_bits in bits
+        ]
+        self._overflow: Dict[str, int] = {}
+        # Which slot each id is in, for O(1) removal.
+        self._slots: Dict[str, Dict[str, int]] = {}
+        self._tick = self._now_tick()
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __contains__(self, job_id: str) -> bool:
+        return job_id in self._slots
+
+    def _now_tick(self) -> int:
+        return int(clock.time() * 1000) // self.tick_ms
+
+    def _slot_for(self, due_tick: int) -> Dict[str, int]:
+        delta = due_tick - self._tick
+        for level, slots in enumerate(self._levels):
+            if delta < self._spans[level]:
+                return slots[(due_tick >> self._shifts[level]) & self._masks[level]]
+        return self._overflow
+
+    def add(self, job_id: str, due: int):
+        """Schedule (or reschedule) job_id to fire at epoch ms `due`."""
+        self.remove(job_id)
+        # Round up so nothing fires before it is due; past-due entries go in
+        # the next tick.
+        due_tick = max(-(-due // self.tick_ms), self._tick + 1)
+        slot = self._slot_for(due_tick)
+        slot[job_id] = due_tick
+        self._slots[job_id] = slot
+
+    def remove(self, job_id: str) -> bool:
+        slot = self._slots.pop(job_id, None)
+        if slot is None:
+            return False
+        del slot[job_id]
+        return True
+
+    def _cascade(self, slot: Dict[str, int]):
+        entries = list(slot.items())
+        slot.clear()
+        for job_id, due_tick in entries:
+            target = self._slot_for(due_tick)
+            target[job_id] = due_tick
+            self._slots[job_id] = target
+
+    def advance(self, until_tick: int):
+        """Fire everything due up to and including tick `until_tick`."""
+        while self._tick < until_tick:
+            # With level 0 empty nothing is due before it wraps around, so
+            # skip to the tick before that, which makes idle stretches cheap.
+            if not any(self._levels[0]):
+                self._tick = max(
+                    self._tick, min(until_tick, self._tick | self._masks[0])
+                )
+                if self._tick == until_tick:
+                    break
+            self._tick += 1
+            # When a level wraps, the next slot of the level above comes down.
+            for level in range(1, len(self._levels) + 1):
+                if (self._tick >> self._shifts[level - 1]) & self._masks[level - 1]:
+                    break
+                if level == len(self._levels):
+                    self._cascade(self._overflow)
+                else:
+                    index = (self._tick >> self._shifts[level]) & self._masks[level]
+                    self._cascade(self._levels[level][index])
+            slot = self._levels[0][self._tick & self._masks[0]]
+            if slot:
+                due = list(slot)
+                slot.clear()
+                for job_id in due:
+                    del self._slots[job_id]
+                self.fire(due)
+
+    async def _run(self):
+        while True:
+            now = self._now_tick()
+            try:
+                self.advance(now)
+            except Exception:
+                logger.exception("Timing wheel tick failed")
+            next_tick_at = (now + 1) * self.tick_ms / 1000
+            await asyncio.sleep(max(next_tick_at - time.time(), 0))
+
+    def start(self):
+        if self._task is None:
+            self._tick = self._now_tick()
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,178 @@
+"""Import and export reminders as JSON Lines or CSV.
+
+    python transfer.py export [--chat CHAT_ID] [-o reminders.jsonl]
+    python transfer.py import reminders.csv
+
+Both directions stream: exports are written straight from a DB cursor and
+imports are inserted in one transaction as the file is read. Rows hold
+id, chat_id, user_id, message, interval (a rule as /remind takes it, or empty
+for a one-shot reminder) and next_run_time (ISO 8601, or epoch milliseconds
+on import). A missing id gets a new one, ids that already exist are skipped,
+and a single invalid row rolls the whole import back.
+
+The /import and /export commands do the same from Telegram. Run the CLI
+import against a live bot only in SCHEDULER_MODE=leased: in local mode a
+running bot does not see imported jobs due within its loaded window until it
+restarts, whereas /import registers them right away.
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import sys
+from datetime import datetime, timezone
+from typing import Iterable, Iterator, List, Optional, TextIO, Tuple
+from uuid import uuid4
+
+from telegram.constants import MessageLimit
+
+import clock
+from recurrence import compile_rule
+from utils.helpers import from_epoch_ms, to_epoch_ms
+
+FIELDS = ("id", "chat_id", "user_id", "message", "interval", "next_run_time")
+FORMATS = ("jsonl", "csv")
+
+
+def guess_format(filename: str) -> str:
+    return "csv" if filename.lower().endswith(".csv") else "jsonl"
+
+
+def write_jobs(rows: Iterable, out: TextIO, fmt: str) -> int:
+    """Write job rows to `out` one at a time. Returns how many were written."""
+    count = 0
+    if fmt == "csv":
+        writer = csv.writer(out)
+        writer.writerow(FIELDS)
+    for row in rows:
+        record = dict(zip(FIELDS, row))
+        record["next_run_time"] = from_epoch_ms(record["next_run_time"]).isoformat()
+        if fmt == "csv":
+            writer.writerow(record.values())
+        else:
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        count += 1
+    return count
+
+
+def _records(lines: Iterable[str], fmt: str) -> Iterator[Tuple[int, dict]]:
+    if fmt == "csv":
+        reader = csv.DictReader(lines)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise ValueError(f"line {line_number}: {e}") from None
+        if not isinstance(record, dict):
+            raise ValueError(f"line {line_number}: expected a JSON object")
+        yield line_number, record
+
+
+def _parse_time(value) -> datetime:
+    if isinstance(value, (int, float)) or str(value).strip().isdigit():
+        return from_epoch_ms(int(value))
+    moment = datetime.fromisoformat(str(value).strip())
+    # Times without an offset are taken as UTC, like everything in the DB.
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+def _parse_job(record: dict, now: datetime) -> Optional[tuple]:
+    """Validate one record and return it as a jobs row, or None if expired."""
+    job_id = str(record.get("id") or "").strip() or uuid4().hex
+    chat_id = int(record["chat_id"])
+    user_id = int(record["user_id"])
+    message = record["message"]
+    if not isinstance(message, str) or not message.strip():
+        raise ValueError("message is empty")
+    if len(message) > MessageLimit.MAX_TEXT_LENGTH:
+        raise ValueError("message is too long")
+    interval = (record.get("interval") or "").strip()
+    rule = compile_rule(interval) if interval else None
+    next_run_time = to_epoch_ms(_parse_time(record["next_run_time"]))
+    # Past due: repeating jobs move to their next slot and one-shot jobs are
+    # dropped, as when the bot starts after being down.
+    if next_run_time < to_epoch_ms(now):
+        if not rule:
+            return None
+        next_run_time = rule.next_after(next_run_time, to_epoch_ms(now))
+    return job_id, chat_id, user_id, message, rule.text if rule else None, next_run_time
+
+
+class ImportStats:
+    def __init__(self):
+        self.read = 0
+        self.expired = 0
+
+    def parse(self, lines: Iterable[str], fmt: str) -> Iterator[tuple]:
+        """Yield validated jobs rows; raises ValueError naming the bad line."""
+        now = clock.now()
+        for line_number, record in _records(lines, fmt):
+            self.read += 1
+            try:
+                row = _parse_job(record, now)
+            except KeyError as e:
+                raise ValueError(f"line {line_number}: missing {e}") from None
+            except (TypeError, ValueError) as e:
+                raise ValueError(f"line {line_number}: {e}") from None
+            if row is None:
+                self.expired += 1
+                continue
+            yield row
+
+
+async def _main(args) -> int:
+    from db import close_db, export_jobs, import_jobs, init_db
+
+    await init_db()
+    try:
+        if args.command == "export":
+            fmt = args.format or guess_format(args.output or "")
+            out = open(args.output, "w", newline="") if args.output else sys.stdout
+            try:
+                count = await export_jobs(
+                    lambda rows: write_jobs(rows, out, fmt), args.chat
+                )
+            finally:
+                if out is not sys.stdout:
+                    out.close()
+            print(f"Exported {count} reminders", file=sys.stderr)
+        else:
+            fmt = args.format or guess_format(args.input)
+            stats = ImportStats()
+            with open(args.input, newline="") as f:
+                inserted, _ = await import_jobs(stats.parse(f, fmt))
+            print(
+                f"Imported {inserted} of {stats.read} reminders"
+                f" ({stats.expired} expired, {stats.read - stats.expired - inserted}"
+                " already present)",
+                file=sys.stderr,
+            )
+    except ValueError as e:
+        print(f"Import failed, nothing was written: {e}", file=sys.stderr)
+        return 1
+    finally:
+        await close_db()
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="write reminders to a file")
+    export.add_argument("-o", "--output", help="file to write (default: stdout)")
+    export.add_argument("--chat", type=int, help="only this chat's reminders")
+    export.add_argument("-f", "--format", choices=FORMATS)
+    import_ = commands.add_parser("import", help="add reminders from a file")
+    import_.add_argument("input")
+    import_.add_argument("-f", "--format", choices=FORMATS)
+    return asyncio.run(_main(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    FrozenSet,
+    Generic,
+    Hashable,
+    Iterable,
+    TypeVar,
+)
+
+from telegram import Bot, User
+
+from settings import (
+    ADMIN_CACHE_TTL,
+    USER_CACHE_SIZE,
+    USER_CACHE_TTL,
+    USER_LOOKUP_CONCURRENCY,
+)
+
+V = TypeVar("V")
+
+
+class AsyncTTLCache(Generic[V]):
+    """Cache for values loaded by coroutines.
+
+    Entries expire after `ttl` seconds and the least recently used entry is
+    evicted once `maxsize` is reached. Concurrent misses for the same key are
+    coalesced so only one loader call is in flight per key.
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[Hashable, tuple[float, V]]" = OrderedDict()
+        self._inflight: Dict[Hashable, "asyncio.Future[V]"] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def peek(self, key: Hashable):
+        """Return the cached value for `key`, or None if missing or expired."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: V):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    async def get(self, key: Hashable, loader: Callable[[], Awaitable[V]]) -> V:
+        value = self.peek(key)
+        if value is not None:
+            return value
+
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._load(key, loader))
+            self._inflight[key] = future
+        # Shield so one cancelled waiter does not cancel the shared load.
+        return await asyncio.shield(future)
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable[V]]) -> V:
+        try:
+            value = await loader()
+            self.set(key, value)
+            return value
+        finally:
+            del self._inflight[key]
+
+    def invalidate(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+
+chat_admins: AsyncTTLCache[FrozenSet[int]] = AsyncTTLCache(ttl=ADMIN_CACHE_TTL)
+
+
+async def get_chat_admin_ids(bot: Bot, chat_id: int) -> FrozenSet[int]:
+    """Return the ids of the chat's administrators, cached per chat."""
+
+    async def load():
+        admins = await bot.get_chat_administrators(chat_id)
+        return frozenset(admin.user.id for admin in admins)
+
+    return await chat_admins.get(chat_id, load)
+
+
+# Keyed by (chat_id, user_id).
+chat_members: AsyncTTLCache[User] = AsyncTTLCache(
+    ttl=USER_CACHE_TTL, maxsize=USER_CACHE_SIZE
+)
+
+
+async def get_chat_users(
+    bot: Bot, chat_id: int, user_ids: Iterable[int]
+) -> Dict[int, User]:
+    """Resolve users of a chat, cached per (chat, user).
+
+    Misses are fetched concurrently with one getChatMember call per distinct
+    user, at most USER_LOOKUP_CONCURRENCY at a time.
+    """
+    semaphore = asyncio.Semaphore(USER_LOOKUP_CONCURRENCY)
+
+    async def fetch(user_id: int) -> User:
+        async def load():
+            async with semaphore:
+                member = await bot.get_chat_member(chat_id, user_id)
+            return member.user
+
+        return await chat_members.get((chat_id, user_id), load)
+
+    distinct = list(dict.fromkeys(user_ids))
+    users = await asyncio.gather(*(fetch(user_id) for user_id in distinct))
+    return dict(zip(distinct, users))
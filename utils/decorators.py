@@ -1,4 +1,6 @@
+import logging
 import random
+import time
 from functools import cache, wraps
 
 from telegram import Update
@@ -6,17 +8,29 @@ from telegram.ext import (
     ContextTypes,
 )
 
+from metrics import handler_latency
 from settings import LIST_OF_USERS, GROUP_ID, PERSONAL_USER_ID
+from utils.cache import get_chat_admin_ids
+from utils.profiling import profiler
+
+logger = logging.getLogger(__name__)
 
 
 def send_action(action):
-    """Sends `action` while processing func command."""
+    """Sends `action` while processing func command.
+
+    The chat action goes out in its own task alongside func rather than
+    before it, so it does not add a round trip to the command.
+    """
 
     def decorator(func):
         @wraps(func)
         async def command_func(update, context, *args, **kwargs):
-            await context.bot.send_chat_action(
-                chat_id=update.effective_message.chat_id, action=action
+            context.application.create_task(
+                context.bot.send_chat_action(
+                    chat_id=update.effective_message.chat_id, action=action
+                ),
+                update=update,
             )
             return await func(update, context, *args, **kwargs)
 
@@ -25,6 +39,37 @@ def send_action(action):
     return decorator
 
 
+def timed(func):
+    """Records how long func takes in the handler latency histogram."""
+
+    @wraps(func)
+    async def wrapped(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            handler_latency.observe(time.perf_counter() - start, func.__name__)
+
+    return wrapped
+
+
+def profiled(func):
+    """Profiles func with cProfile while profiling is on (see utils.profiling)."""
+
+    @wraps(func)
+    async def wrapped(*args, **kwargs):
+        profile = profiler.start()
+        if profile is None:
+            return await func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            profiler.finish(profile, func.__name__, time.perf_counter() - start)
+
+    return wrapped
+
+
 def restricted(func):
     @wraps(func)
     async def wrapped(update: Update, context, *args, **kwargs):
@@ -41,7 +86,7 @@ def restricted(func):
         ]
         message = random.choice(unauthorized_messages)
         if user_id not in LIST_OF_USERS:
-            print(f"Unauthorized access denied for {user_id}.")
+            logger.warning("Unauthorized access denied for %s", user_id)
             await update.message.reply_text(message)
             return
         return await func(update, context, *args, **kwargs)
@@ -58,9 +103,8 @@ def group_admin_only(func):
         user_id = update.effective_user.id
         chat_id = update.effective_chat.id
 
-        # Get the list of administrators in the chat
-        chat_admins = await context.bot.get_chat_administrators(chat_id)
-        admin_ids = [admin.user.id for admin in chat_admins]
+        # Get the (cached) set of administrators in the chat
+        admin_ids = await get_chat_admin_ids(context.bot, chat_id)
 
         unauthorized_messages = [
             "Access denied, mortal!",
@@ -75,7 +119,7 @@ def group_admin_only(func):
         message = random.choice(unauthorized_messages)
 
         if user_id not in admin_ids:
-            print(f"Unauthorized access denied for {user_id}.")
+            logger.warning("Unauthorized access denied for %s", user_id)
             await update.message.reply_text(message)
             return
         return await func(update, context, *args, **kwargs)
@@ -102,17 +146,16 @@ def mygroup_admins_or_personal_only(func):
             "You're not on the list!",
             "Denied. Try again never.",
         ]
+        message = random.choice(unauthorized_messages)
         if chat_id != GROUP_ID and user_id != PERSONAL_USER_ID:
-            message = random.choice(unauthorized_messages)
-            print(f"Unauthorized access denied for {user_id}.")
+            logger.warning("Unauthorized access denied for %s", user_id)
             await update.message.reply_text(message)
             return
 
         if chat_id == GROUP_ID:
-            chat_admins = await context.bot.get_chat_administrators(chat_id)
-            admin_ids = (admin.user.id for admin in chat_admins)
+            admin_ids = await get_chat_admin_ids(context.bot, chat_id)
             if user_id not in admin_ids:
-                print(f"Unauthorized access denied for {user_id}.")
+                logger.warning("Unauthorized access denied for %s", user_id)
                 await update.message.reply_text(message)
                 return
 
@@ -1,8 +1,21 @@
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+
+import clock
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def to_epoch_ms(moment: datetime) -> int:
+    """Convert an aware datetime to integer epoch milliseconds, as stored in the DB."""
+    return (moment - EPOCH) // timedelta(milliseconds=1)
+
+
+def from_epoch_ms(epoch_ms: int) -> datetime:
+    return EPOCH + timedelta(milliseconds=epoch_ms)
 
 
 def format_time_left(scheduled_time: datetime):
-    time_left = scheduled_time - datetime.now(timezone.utc)
+    time_left = scheduled_time - clock.now()
     days, seconds = time_left.days, time_left.seconds
     hours = days * 24 + seconds // 3600
     minutes = (seconds % 3600) // 60
@@ -16,3 +29,25 @@ def format_time_left(scheduled_time: datetime):
     time_message += f"{seconds} seconds"
 
     return time_message
+
+
+def pack_messages(texts, limit: int, separator: str = "\n\n"):
+    """Join texts into as few messages of at most `limit` characters as possible.
+
+    Texts are kept whole where they fit; one longer than `limit` is cut into
+    `limit`-sized pieces.
+    """
+    chunks = []
+    current = ""
+    for text in texts:
+        pieces = [text[i : i + limit] for i in range(0, len(text), limit)] or [""]
+        for piece in pieces:
+            if current and len(current) + len(separator) + len(piece) <= limit:
+                current += separator + piece
+            else:
+                if current:
+                    chunks.append(current)
+                current = piece
+    if current:
+        chunks.append(current)
+    return chunks
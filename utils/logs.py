@@ -0,0 +1,121 @@
+"""Logging that stays off the event loop.
+
+setup_logging() points the root logger at a QueueHandler, so a log call on
+the event loop only appends the record to a queue; a QueueListener thread
+formats it, as text or one JSON object per line (LOG_FORMAT), and writes it
+to stderr. Noisy loggers can be held to a number of records per second
+(LOG_RATE_LIMITS); the next record let through says how many were dropped.
+"""
+
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+from settings import LOG_FORMAT, LOG_LEVEL, LOG_RATE_LIMITS
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+_listener: Optional[QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most `limits[name]` records per second per logger.
+
+    A limit applies to the named logger and its children. Records of
+    WARNING and above always pass.
+    """
+
+    def __init__(self, limits: Dict[str, float]):
+        super().__init__()
+        self.limits = limits
+        # Per limited logger: [tokens, last refill, records dropped].
+        self._state: Dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def _limit_for(self, name: str) -> Optional[str]:
+        while name:
+            if name in self.limits:
+                return name
+            name = name.rpartition(".")[0]
+        return None
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        name = self._limit_for(record.name)
+        if name is None:
+            return True
+        rate = self.limits[name]
+        now = time.monotonic()
+        with self._lock:
+            state = self._state.setdefault(name, [rate, now, 0])
+            state[0] = min(rate, state[0] + (now - state[1]) * rate)
+            state[1] = now
+            if state[0] < 1:
+                state[2] += 1
+                return False
+            state[0] -= 1
+            dropped, state[2] = state[2], 0
+        if dropped:
+            record.msg = f"{record.msg} [{dropped} earlier messages dropped]"
+        return True
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The record never leaves the process, so leave all the formatting to
+        # the listener thread instead of doing it on the caller's.
+        return record
+
+
+def setup_logging():
+    """Send all logging through a background thread, as configured in settings."""
+    global _listener
+    if _listener is not None:
+        return
+    output = logging.StreamHandler(sys.stderr)
+    if LOG_FORMAT == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter(TEXT_FORMAT))
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    handler = _QueueHandler(records)
+    if LOG_RATE_LIMITS:
+        handler.addFilter(RateLimitFilter(LOG_RATE_LIMITS))
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    _listener = QueueListener(records, output)
+    _listener.start()
+
+
+def stop_logging():
+    """Write out the queued records and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,90 @@
+import cProfile
+import logging
+import os
+import random
+import time
+from typing import List, Optional
+
+from settings import (
+    PROFILE_DIR,
+    PROFILE_ENABLED,
+    PROFILE_KEEP,
+    PROFILE_SAMPLE_RATE,
+    PROFILE_THRESHOLD,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Profiler:
+    """cProfile runs of slow calls, saved to a bounded ring of files.
+
+    While enabled, each call wrapped with @profiled runs under cProfile and
+    its profile is kept if the call took at least `threshold` seconds, or
+    for a `sample_rate` fraction of the rest. Only one profile runs at a
+    time: calls that start while another is being profiled are not profiled
+    themselves, but whatever they do on the event loop meanwhile shows up in
+    the running profile, which is usually what makes a slow call slow.
+    Profiles are written to `directory` as <epoch ms>-<name>-<duration>.prof
+    and only the latest `keep` files are kept.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        keep: int,
+        threshold: float,
+        sample_rate: float,
+        enabled: bool = False,
+    ):
+        self.directory = directory
+        self.keep = keep
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.enabled = enabled
+        self._active: Optional[cProfile.Profile] = None
+
+    def start(self) -> Optional[cProfile.Profile]:
+        """Start profiling a call, unless profiling is off or already running."""
+        if not self.enabled or self._active is not None:
+            return None
+        self._active = cProfile.Profile()
+        self._active.enable()
+        return self._active
+
+    def finish(
+        self, profile: cProfile.Profile, name: str, elapsed: float
+    ) -> Optional[str]:
+        """Stop `profile` and save it if the call qualifies. Returns the path."""
+        profile.disable()
+        self._active = None
+        if elapsed < self.threshold and random.random() >= self.sample_rate:
+            return None
+        try:
+            return self._save(profile, name, elapsed)
+        except OSError as e:
+            logger.warning("Could not save profile of %s: %s", name, e)
+            return None
+
+    def _save(self, profile: cProfile.Profile, name: str, elapsed: float) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        filename = f"{int(time.time() * 1000)}-{name}-{int(elapsed * 1000)}ms.prof"
+        path = os.path.join(self.directory, filename)
+        profile.dump_stats(path)
+        for old in self.files()[: -self.keep]:
+            os.remove(old)
+        return path
+
+    def files(self) -> List[str]:
+        """Saved profiles, oldest first."""
+        if not os.path.isdir(self.directory):
+            return []
+        names = (name for name in os.listdir(self.directory) if name.endswith(".prof"))
+        # The epoch ms prefix has the same width for centuries, so names sort
+        # by time.
+        return [os.path.join(self.directory, name) for name in sorted(names)]
+
+
+profiler = Profiler(
+    PROFILE_DIR, PROFILE_KEEP, PROFILE_THRESHOLD, PROFILE_SAMPLE_RATE, PROFILE_ENABLED
+)
@@ -0,0 +1,62 @@
+"""Fire reminders without taking updates, as an extra SCHEDULER_MODE=leased worker.
+
+Only one process can receive updates from Telegram (main.py, by polling or
+webhook), but any number of workers can share its jobs.db and send the
+reminders that come due. Start them with the same environment as main.py:
+
+    SCHEDULER_MODE=leased python worker.py
+"""
+
+import asyncio
+import signal
+import sys
+
+from telegram.ext import Application
+
+from main import build_request, post_init, post_shutdown, post_stop
+from settings import BOT_TOKEN, SCHEDULER_MODE
+from utils.logs import setup_logging, stop_logging
+
+
+async def run_worker():
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(build_request())
+        .updater(None)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    # The lifecycle of Application.run_polling, minus the updater.
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    try:
+        await stop.wait()
+    finally:
+        await application.stop()
+        await application.post_stop(application)
+        await application.shutdown()
+        await application.post_shutdown(application)
+
+
+def main():
+    if SCHEDULER_MODE != "leased":
+        print("worker.py needs SCHEDULER_MODE=leased")
+        sys.exit()
+    setup_logging()
+    try:
+        asyncio.run(run_worker())
+    finally:
+        stop_logging()
+
+
+if __name__ == "__main__":
+    main()